@@ -1,8 +1,16 @@
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import copy
 from WaterUser import WaterUser
 from schedule import MarketActivation
 from mesa import Model
+from clearing import discriminatory_price, uniform_price, network_flow, bilateral
+from ledger import Ledger
+from orderbook import OrderBook
+from basin import Basin
+from state import AgentState, SIDER, BUYER, SELLER, NORMAL
+from sheet import tolerance
+from sampler import sample_iter, grid_size
+from streams import Stream, spawn
 
 
 def local_optimal(upper_bound, u):
@@ -19,95 +27,148 @@ def local_optimal(upper_bound, u):
         return c_2
 
 
-def role_update(market):
-    i = 0
-    for user in market.users:
-        market.role[i] = user.market_role
-        i += 1
-
-
-def x_update(market):
-    i = 0
-    for user in market.users:
-        market.x[i] = user.x
-        i += 1
-
-
-def flow_update(market):
-    i = 0
-    for user in market.users:
-        market.f_matrix[i] = user.outflow
-        i += 1
-
-
-def label_get(market, label):
-    l_list = [user.unique_id for user in market.users if user.label == label]
+def label_get(market, label):  # the index set of the users with the label
+    l_list = market.state.index['label'][label]
     return l_list
 
 
 class WaterMarket(Model):
 
-    def __init__(self, basin_matrix, precipitation, out_min, penalty, res, u, water_permit, beta, mu, market):
+    def __init__(self, basin_matrix, precipitation, out_min, penalty, res, u, water_permit, beta, mu, market,
+                 sheet_tol=tolerance, seed=None, learn_iter=sample_iter, learn_time=None,
+                 learn_mode='mh', grid_size=grid_size, proposal='independence', routing='init',
+                 balance='random', prune=False, partners=8, learn_workers=None):
         # basin_matrix is a adjacent matrix (np.array) of a directed graph for a waterway
         # e.g. for a Y-shape river system, the basin_matrix is
         # [[0, 0, 1, 0],
         #  [0, 0, 1, 0],
         #  [0, 0, 0, 1],
         #  [0, 0, 0, 0]]
+        # basin_matrix, out_min and penalty can be dense arrays or scipy.sparse matrices,
+        # they are kept per waterway in self.basin
+        # market is 'discriminatory-price' (a double auction with a midpoint price for every pair), 'uniform-price'
+        # (a call auction with one clearing price for all), 'network-flow' (trades between connected users
+        # cleared together with the flows of the basin in one linear program)
+        # 'bilateral negotiations' (every buyer negotiates with at most partners users upstream of it)
+        # or 'continuous' (a double auction on an order book kept across the steps, the users post, amend
+        # or cancel their orders as their bids change, and every step restores the orders to the current bids)
+        # sheet_tol is the recency weight below which the records in users' sheets are folded (0 keeps all)
+        # seed makes a run reproducible: every user and the market draw from their own stream spawned from it
+        # learn_iter bounds the sampling iterations of a learn() call and learn_time (in seconds) its duration,
+        # a user whose budget runs out keeps the state of its chain
+        # learn_mode is 'mh' (metropolis_hastings) or 'grid' (inverse-CDF sampling on a grid_size x grid_size grid)
+        # proposal of 'mh' is 'independence' or 'adaptive' (a tuned random walk with an early-stopping burn-in)
+        # routing is 'init' (outflows are routed downstream once) or 'step' (they are routed again at every step)
+        # balance is 'random' (users over their limit cut x or an outflow by random ratios until they meet it)
+        # or 'projection' (they move to the nearest feasible x and outflows, keeping out_min where possible)
+        # learn_workers samples the users learning after a trade in a pool of that many processes
+        # (see sampler.learn_pool), the draws don't depend on the number of workers; close() (or a with block)
+        # shuts the pool down
+        # prune restricts the discriminatory-price matching to the pairs whose seller's water can flow to the
+        # buyer, looked up in the reachability index of the basin; it does not apply to the uniform-price market,
+        # whose single price comes from the unrestricted supply and demand curves
         super().__init__()
-        self.user_amount = basin_matrix.shape[0]
+        self.prune = prune
+        self.routing = routing
+        self.balance_mode = balance
+        self.learn_mode = learn_mode
+        self.proposal = proposal
+        self.grid_size = grid_size
+        self.sheet_tol = sheet_tol
+        self.learn_iter = learn_iter
+        self.learn_time = learn_time
+        self.learn_workers = learn_workers
+        self.pool = ProcessPoolExecutor(learn_workers) if learn_workers else None
+        self.basin = Basin(basin_matrix, precipitation, out_min, penalty)
+        self.user_amount = self.basin.n
         self.basin_matrix = basin_matrix
+        seeds = spawn(seed, self.user_amount + 1)
+        self.stream = Stream(seeds[-1])
+        self.state = AgentState(self.user_amount)  # the state of all the users, see WaterUser
+        self.basin.refresh(self.state.limit)  # the basin keeps the limits of the users in the state
+        self.basin.dirty = self.state.dirty  # and marks the users whose flows change
 
-        sample_size = np.random.randint(self.user_amount, size=self.user_amount)
+        sample_size = self.stream.integers(self.user_amount, size=self.user_amount)
         x_initial = [-u_i[1]/(2*u_i[0]) for u_i in u]
-        # f_matrix[i][j] is the flow from agent i to agent j
-        self.f_matrix = np.diag(precipitation)
-
         self.schedule = MarketActivation(self)
         for i in range(0, self.user_amount):
             water_user = WaterUser(unique_id=i, model=self,
                                    u_a=u[i][0], u_b=u[i][1], u_c=u[i][2], x=x_initial[i],
-                                   w=water_permit[i], L=basin_matrix[i][i],
-                                   out_link=np.nonzero(basin_matrix[i])[0], in_link=np.nonzero(basin_matrix.transpose()[i])[0],
-                                   out_min=out_min[i], penalty=penalty[i], res=res[i],
-                                   transaction_size=sample_size[i], beta=beta[i], mu=mu[i])
+                                   w=water_permit[i], L=self.basin.store[i],
+                                   out_link=self.basin.out_link(i), in_link=self.basin.in_link(i),
+                                   out_min=self.basin.out_min[self.basin.out_slice(i)],
+                                   penalty=self.basin.penalty[self.basin.out_slice(i)], res=res[i],
+                                   transaction_size=sample_size[i], beta=beta[i], mu=mu[i],
+                                   seed=seeds[i])
             self.schedule.add(water_user)
 
         self.schedule.agent_count()
         self.market = market
+        if market == 'bilateral negotiations':
+            self.neighbor = self.basin.neighbors(partners)  # the candidate sellers of every buyer, upstream of it
+        if market == 'continuous':
+            self.book = OrderBook(self.user_amount)
         self.users = self.schedule.agents
         self.users_keys = list(self.schedule.agents_keys)
 
+        # ledger holds the trades of the last step as (buyer, seller, price, amount) arrays
+        # its dense views are p_matrix and a_matrix:
         # p_matrix[i][j] is the transaction price between agent i and agent j
         # p_matrix[i][j] = 0 if no transaction happens
-        self.p_matrix = np.zeros((self.user_amount, self.user_amount))
-        self.p_old = np.zeros((self.user_amount, self.user_amount))
-
         # a_matrix[i][j] is the transaction amount from agent i to agent j
         # a_matrix[i][j] is positive if i is the buyer and j is the seller
         # a_matrix[i][j] = 0 if no transaction happens
-        self.a_matrix = np.zeros((self.user_amount, self.user_amount))
-        # initialize the outflow
-        for user in self.users:
-            user.water_table()
-            user.outflow_initialize()
-
-        self.role = np.array([user.market_role for user in self.users])
-        self.x = [user.x for user in self.users]
+        self.ledger = Ledger(self.user_amount)
+        self.p_old = self.ledger.sparse_price()
+        # initialize the outflow, routing the water downstream in topological order of the basin
+        self.basin.route(self.state.x)
+
         self.running = True
 
+    def close(self):  # shut the learning pool down, the model then learns in the main process
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def role(self):  # market roles of all the users
+        return self.state.market_role
+
+    @property
+    def x(self):  # water use of all the users
+        return self.state.x
+
+    @property
+    def f_matrix(self):  # dense view of the flows, f_matrix[i][j] is the flow from agent i to agent j
+        return self.basin.flow_matrix()
+
+    @property
+    def p_matrix(self):  # dense view of the prices in the ledger
+        return self.ledger.price_matrix()
+
+    @property
+    def a_matrix(self):  # dense view of the amounts in the ledger
+        return self.ledger.amount_matrix()
+
     def step(self):
-        self.schedule.step()  # user.step() for all users in self.users
+        if self.routing == 'step':
+            self.basin.route(self.state.x)  # every user's limit is consistent after one sweep
+        self.schedule.step()  # step the users in self.users whose inputs changed
         flag = self.check()  # check if all sider, only sider and buyer, or only sider and seller
         if not flag:
             self.transaction()
-            self.schedule.benefit(self.p_matrix, self.a_matrix)
-            if self.market == 'discriminatory-price':
-                self.schedule.learn_d(self.p_matrix)
+            self.schedule.benefit(self.ledger)
+            self.schedule.learn_d(self.ledger)
             if self.schedule.time % 50 == 49:  # if choose 1, easily stop at time 1
-                p_new = copy.deepcopy(self.p_matrix)  # deep copy
+                p_new = self.ledger.sparse_price()
                 p_delta = p_new - self.p_old
-                if np.sum(np.abs(p_delta)) < 10**(-8):
+                if abs(p_delta).sum() < 10**(-8):
                     self.running = False
                 else:
                     self.p_old = p_new
@@ -115,103 +176,116 @@ class WaterMarket(Model):
             self.running = False
 
     def transaction(self):
-        print(self.role)
-        self.p_matrix = np.zeros((self.user_amount, self.user_amount))
-        self.a_matrix = np.zeros((self.user_amount, self.user_amount))
-        # if the market is the discriminatory-price double auction market
-        if self.market == 'discriminatory-price':
-            buyer_price = np.array([user.bid_price for user in self.users if user.market_role == 'buyer'])
-            b_index = np.array([user.unique_id for user in self.users if user.market_role == 'buyer'])
-            print(buyer_price)
-            buyer_amount = np.array([user.bid_amount for user in self.users if user.market_role == 'buyer'])
-
-            seller_price = np.array([user.bid_price for user in self.users if user.market_role == 'seller'])
-            s_index = np.array([user.unique_id for user in self.users if user.market_role == 'seller'])
-            print(seller_price)
-            seller_amount = np.array([user.bid_amount for user in self.users if user.market_role == 'seller'])
-
-            # for buyers, we sort it by their price offers in descending order
-            buyer_sort = -buyer_price
-            buyer_order = buyer_sort.argsort()
-            # for sellers, we sort it by their price offers in ascending order
-            seller_order = seller_price.argsort()
-
-            j = 0  # j is the seller order
-            for i in buyer_order:  # i is the buyer order in buyer_price/amount
-                while buyer_amount[i] > 0 and j<seller_order.shape[0]:
-                    buyer_id = b_index[i]  # i is the unique_id of ith buyer
-                    j_index = seller_order[j]  # seller_order[j] is the index of jth seller in seller_price/amount
-                    seller_id = s_index[j_index]  # j is the unique_id of jth seller
-                    if buyer_price[i] > seller_price[j_index]:
-                        # update the p_matrix
-                        price = 0.5*(buyer_price[i]+seller_price[j_index])
-                        self.p_matrix[buyer_id][seller_id] = price
-                        self.p_matrix[seller_id][buyer_id] = price
-                        # update the a_matrix
-                        amount = min(buyer_amount[i],seller_amount[j_index])
-                        self.a_matrix[buyer_id][seller_id] = amount
-                        self.a_matrix[seller_id][buyer_id] = -amount
-                        buyer_amount[i] -= amount
-                        seller_amount[j_index] -= amount
-
-                        # update users' property
-                        self.users[buyer_id].step()
-                        self.users[seller_id].step()
-                        # update market_role
-                        role_update(self)
-                        if amount == seller_amount[j_index]:
-                            j += 1  # turn to the next seller
-                    else:  # transaction fail
-                        break
-            print(self.schedule.time)  # iteration times
-            print(self.p_matrix)
-            print(self.f_matrix)
+        self.ledger = Ledger(self.user_amount)
+        # if the market is the discriminatory-price double auction market or the uniform-price call auction
+        if self.market in ('discriminatory-price', 'uniform-price'):
+            state = self.state
+            b_index = state.index['market_role'][BUYER].array()
+            buyer_price = state.bid_price[b_index]
+            buyer_amount = state.bid_amount[b_index]
+
+            s_index = state.index['market_role'][SELLER].array()
+            seller_price = state.bid_price[s_index]
+            seller_amount = state.bid_amount[s_index]
+
+            # buyers are sorted by their price offers in descending order, sellers in ascending order,
+            # and the volumes are matched along the cumulative sums of both sides
+            if self.market == 'uniform-price':
+                i, j, price, amount = uniform_price(buyer_price, buyer_amount, seller_price, seller_amount)
+            else:
+                candidates = self.basin.sources(s_index, b_index) if self.prune else None
+                i, j, price, amount = discriminatory_price(buyer_price, buyer_amount, seller_price, seller_amount,
+                                                           candidates)
+            buyer_id = b_index[i]
+            seller_id = s_index[j]
+            # record the trades
+            self.ledger = Ledger(self.user_amount, buyer_id, seller_id, price, amount)
+            # update users' property once the market is cleared
+            self.schedule.traded(buyer_id, seller_id)
+        # if the market clears the trades and the flows of the basin together (see clearing.network_flow)
+        elif self.market == 'network-flow':
+            state = self.state
+            b_index = state.index['market_role'][BUYER].array()
+            s_index = state.index['market_role'][SELLER].array()
+            # a seller can sell to the buyers its water can flow to, at a price below their offers
+            ptr, pair_s = self.basin.sources(s_index, b_index)
+            pair_b = np.repeat(np.arange(b_index.shape[0]), np.diff(ptr))
+            keep = state.bid_price[b_index][pair_b] > state.bid_price[s_index][pair_s]
+            pair_b, pair_s = pair_b[keep], pair_s[keep]
+            # every user keeps its water use unless the water can't reach it
+            i, j, amount, flow, x = network_flow(self.basin, state.x.copy(), b_index, state.bid_price[b_index],
+                                                 state.bid_amount[b_index], s_index, state.bid_price[s_index],
+                                                 state.bid_amount[s_index], pair_b, pair_s)
+            buyer_id = b_index[i]
+            seller_id = s_index[j]
+            price = 0.5*(state.bid_price[buyer_id]+state.bid_price[seller_id])
+            self.ledger = Ledger(self.user_amount, buyer_id, seller_id, price, amount)
+            self.basin.set_flows(np.arange(flow.shape[0]), flow)
+            state.dirty |= state.x != x
+            state.x[:] = x
+            self.schedule.traded(buyer_id, seller_id)
+        # if the market is the continuous double auction
+        elif self.market == 'continuous':
+            state, book = self.state, self.book
+            trades = [], [], [], []
+            # the users whose bids changed or whose orders filled in the last step send their order events in a
+            # random order, every event is matched against the book at once; every order trades at most the
+            # current bid_amount of its user in a step, as the ledger and the benefits count the trades of a step
+            events = book.events(state.market_role, state.bid_price, state.bid_amount)
+            for user_id in events[np.argsort(self.stream.random(events.shape[0]), kind='stable')]:
+                fills = book.post(user_id, state.market_role[user_id], state.bid_price[user_id],
+                                  state.bid_amount[user_id])
+                for trade, fill in zip(trades, fills):
+                    trade.extend(fill)
+            buyer_id, seller_id, price, amount = (np.asarray(trade) for trade in trades)
+            self.ledger = Ledger(self.user_amount, buyer_id, seller_id, price, amount)
+            self.schedule.traded(buyer_id.astype(int), seller_id.astype(int))
         # if the market is the bilateral negotiation market
         elif self.market == 'bilateral negotiations':
-            pass
+            state = self.state
+            b_index = state.index['market_role'][BUYER].array()
+            # the buyers negotiate in a random order, every one with its candidate sellers
+            order = b_index[np.argsort(self.stream.random(b_index.shape[0]), kind='stable')]
+            buyer_id, seller_id, price, amount = bilateral(order, self.neighbor, state.market_role == SELLER,
+                                                           state.bid_price, state.bid_amount)
+            self.ledger = Ledger(self.user_amount, buyer_id, seller_id, price, amount)
+            self.schedule.traded(buyer_id, seller_id)
 
     def check(self):
+        count = self.state.count['market_role']  # the number of users of every role
         # all sider
-        if np.sum(self.role=='sider') == self.user_amount:
+        if count[SIDER] == self.user_amount:
             return True
         # only seller and sider in the market
-        elif np.sum(self.role=='seller') + np.sum(self.role=='sider') == self.user_amount:
+        elif count[SELLER] + count[SIDER] == self.user_amount:
             # randomly choose a user until he is NOT an 'over' user
             # because he need water permit
-            list = label_get(self, 'normal')
+            list = label_get(self, NORMAL)
             list_l = len(list)
             if list_l == 0:
                 num = self.user_amount
-                index = np.random.randint(0, num)
-                ratio = np.random.uniform(1, 1.5)
+                index = self.stream.integers(0, num)
+                ratio = self.stream.uniform(1, 1.5)
                 self.users[index].x = min(self.users[index].permit*ratio, self.users[index].limit)
-                self.users[index].step()
-                role_update(self)
-                x_update(self)
+                self.schedule.refresh([index])
             else:
                 num = list_l
-                index = list[np.random.randint(0, num)]
-                ratio = np.random.uniform(1, 1.5)
+                index = list[self.stream.integers(0, num)]
+                ratio = self.stream.uniform(1, 1.5)
                 self.users[index].x = min(self.users[index].permit*ratio, self.users[index].limit)
-                self.users[index].step()
-                role_update(self)
-                x_update(self)
+                self.schedule.refresh([index])
         # only buyer and sider in the market
-        elif np.sum(self.role == 'buyer') + np.sum(self.role == 'sider') == self.user_amount:
+        elif count[BUYER] + count[SIDER] == self.user_amount:
             # randomly choose a user
             num = self.user_amount
-            index = np.random.randint(0, num)
-            ratio = np.random.uniform(0.5, 1)
+            index = self.stream.integers(0, num)
+            ratio = self.stream.uniform(0.5, 1)
             self.users[index].x = self.users[index].permit * ratio
-            self.users[index].step()
-            role_update(self)
-            x_update(self)
-        # if we have buyer, seller and sider, just update the role and water use after every agent steps
-        role_update(self)
-        x_update(self)
+            self.schedule.refresh([index])
+        # roles and water use are read from self.state, so they are up to date after every agent steps
         # check if the water permits are fully used
         sum_x = np.sum(self.x)
-        sum_w = np.sum([user.permit for user in self.users])
+        sum_w = np.sum(self.state.permit)
         if sum_x == sum_w:
             return True
         else:
@@ -1,73 +1,120 @@
 import numpy as np
-import random
-from scipy.stats import truncnorm
 from mesa import Agent
+from sampler import learn_sample
+from sheet import Sheet
+from streams import Stream
+from state import Column, TrackedColumn, CodeColumn, SIDER, BUYER, SELLER, NORMAL, OVER
 
 
 w = 0.05  # market_transaction_ratio
-phi = 0.1  # regency ratio
-pi = np.pi  # 3.1415926
 excess_fee = -1000  # fine charged for the unit excess water use
 
 
-def propensity(x, mu, sheet, ini):   # the sheet is a record of (x, mu, benefit)
-    q = ini
-    for i in range(1, len(sheet)):
-        E = (sheet[i][2]-sheet[i-1][2])/abs(sheet[i-1][2])
-        E = E*1/(2*pi)*np.exp(-0.5*((x-sheet[i][0])/sheet[i][0])**2-0.5*((mu-sheet[i][1])/sheet[i][0])**2)
-        q = (1-phi)*q + E
-    return q
-
-# metropolis_hastings sampling algorithms
-def metropolis_hastings(user):
-   # initialization
-    x = user.x
-    mu = user.mu
-    sheet = user.sheet
-    # burn-in process
-    for i in range(0, 10000):
-        # select a candidate for x, mu
-        x_candidate = truncnorm.rvs(0, user.limit)
-        if user.market_role == 'buyer':
-            mu_candidate = truncnorm.rvs(0, 1)
-        else:
-            mu_candidate = truncnorm.rvs(0, 10)
-        # compute the acceptance rate
-        q_candidate = propensity(x=x_candidate, mu=mu_candidate, sheet=sheet, ini=user.p_ini)
-        q_t = propensity(x=x, mu=mu, sheet=sheet, ini=user.p_ini)
-        rate = min(1, q_candidate/q_t)
-        u = random.uniform(0, 1)
-        if u < rate:
-            x = x_candidate
-            mu = mu_candidate
-    # do sampling
-    while True:
-        x_candidate = truncnorm.rvs(0, user.limit)
-        print("User limit: " + str(user.limit))
-        if user.market_role == 'buyer':
-            mu_candidate = truncnorm.rvs(0, 1)
-        else:
-            mu_candidate = truncnorm.rvs(0, 10)
-        q_candidate = propensity(x=x_candidate, mu=mu_candidate, sheet=sheet, ini=user.p_ini)
-        q_t = propensity(x=x, mu=mu, sheet=sheet, ini=user.p_ini)
-        rate = min(1, q_candidate / q_t)
-        u = random.uniform(0, 1)
-        if u < rate:
-            break
-        #if t > 100000:
-            #break
-        #t += 1
-    return x_candidate, mu_candidate
+def role_choose_all(state, ids=None):
+    # choose the role in the market of the users ids (all users by default): buyer if water use > permit,
+    # seller if water use < permit
+    ids = np.arange(state.n) if ids is None else np.asarray(ids, dtype=int)
+    x = state.x[ids]
+    q = state.permit[ids]
+    state.recode('market_role', ids, np.where(x > q, BUYER, np.where(x < q, SELLER, SIDER)))
+
+
+def label_choose_all(state, ids=None):
+    # choose the label of the users ids (all users by default): 'over' if there are some water permits which
+    # can't be used (under water balance, use <= limit, an 'over' user must be a seller)
+    ids = np.arange(state.n) if ids is None else np.asarray(ids, dtype=int)
+    state.recode('label', ids, np.where(state.limit[ids] < state.permit[ids], OVER, NORMAL))
+
+
+def bid_all(state, ids):
+    # bids of the buyers and the sellers among the users ids
+    ids = np.asarray(ids, dtype=int)
+    role = state.market_role[ids]
+    b = ids[role == BUYER]
+    state.bid_amount[b] = state.x[b] - state.permit[b]
+    state.reservation_price[b] = state.res[b] / (1+w)
+    state.bid_price[b] = (1 - state.mu[b]) * state.reservation_price[b]  # mu is in (0, 1)
+    s = ids[role == SELLER]
+    state.bid_amount[s] = state.permit[s] - state.x[s]
+    state.reservation_price[s] = state.res[s] / (1 - w)
+    state.bid_price[s] = (1 + state.mu[s]) * state.reservation_price[s]  # mu is in (0, infinity)
+
+
+def propensity_initialization_all(state, ids):
+    # initialize the propensity of the users ids
+    ids = np.asarray(ids, dtype=int)
+    state.p_ini[ids] = np.where(state.market_role[ids] == BUYER, 1/state.limit[ids], 1/(10*state.limit[ids]))
+
+
+def benefit_all(state, basin, ledger):
+    # net benefit of all the users at once, from the ledger and the flows on every edge
+    # returns the ids of the users whose trades met their demand (x - permit), who record them in their sheets
+    # utility brought by the use of water
+    u = state.u_a * state.x ** 2 + state.u_b * state.x + state.u_c
+    # transaction income/cost (here, we all use 'income', which is negative for buyers)
+    value = ledger.price*ledger.amount
+    paid = np.bincount(ledger.buyer, weights=value, minlength=state.n)
+    received = np.bincount(ledger.seller, weights=value, minlength=state.n)
+    income = received - paid - w*(paid + received)
+    # penalty caused by the violation of minimum outflow
+    f = basin.penalty*(basin.flow-basin.out_min)
+    fine_min = np.bincount(basin.src, weights=np.minimum(f, 0), minlength=state.n)
+    # penalty caused by the excess water use
+    net = (np.bincount(ledger.buyer, weights=ledger.amount, minlength=state.n)
+           - np.bincount(ledger.seller, weights=ledger.amount, minlength=state.n))
+    fine_excess = excess_fee*np.maximum(0, state.x-state.permit-net)
+    state.benefit[:] = u + income + fine_min + fine_excess
+    return np.nonzero(net == state.x-state.permit)[0]
+
+
+def learn_price_all(state, ids, tau):
+    # learn the price: the users ids move mu toward the average price tau of the market
+    ids = np.asarray(ids, dtype=int)
+    step = state.beta[ids] * (tau - state.bid_price[ids]) / state.reservation_price[ids]
+    mu = state.mu[ids]
+    state.mu[ids] = np.where(state.market_role[ids] == BUYER, np.clip(mu - step, 0, 1), np.maximum(mu + step, 0))
+    state.dirty[ids] = True
+
+
+def learn_by_random_all(users):
+    # no transaction occurs in the market: the users cut mu by a random ratio, drawn from their own streams
+    if len(users) == 0:
+        return
+    state = users[0].model.state
+    ids = np.array([user.unique_id for user in users])
+    state.mu[ids] *= np.array([user.stream.uniform(0.5, 1) for user in users])
+    state.dirty[ids] = True
 
 
 class WaterUser(Agent):
+    # the state of the user is kept in the columns of model.state, the user is a view on its row
+    x = TrackedColumn()
+    permit = TrackedColumn()
+    limit = Column()
+    mu = TrackedColumn()
+    bid_price = Column()
+    bid_amount = Column()
+    reservation_price = Column()
+    benefit = Column()
+    market_role = CodeColumn()  # SIDER, BUYER or SELLER
+    label = CodeColumn()  # NORMAL or OVER
+    u_a = Column()
+    u_b = Column()
+    u_c = Column()
+    store = Column()
+    precipitation = Column()
+    res = Column()
+    beta = Column()
+    p_ini = Column()
+    time = Column()
 
     def __init__(self, unique_id, model,
                  x, u_a, u_b, u_c, w, L,
                  out_link, in_link, out_min, penalty,
                  transaction_size, res,
-                 beta, mu):
+                 beta, mu, seed=None):
         super().__init__(unique_id, model)
+        self.stream = Stream(seed)  # the user's own random stream
         self.x = x  # water use
         self.u_a = u_a
         self.u_b = u_b
@@ -76,148 +123,60 @@ class WaterUser(Agent):
         self.store = L  # local water available
         self.out_link = out_link  # the unique_id of users who have waterways in the downstream of the user
         self.in_link = in_link
-        self.out_min = out_min  # the minimum outflow on each out_link
+        self.out_min = out_min  # the minimum outflow on each out_link (in the order of out_link)
         self.penalty = penalty
-        self.role_choose()
+        role_choose_all(self.model.state, [self.unique_id])
         self.res = res  # parameter for reservation price, represents marginal profit of the water
         self.transaction_size = transaction_size
         self.beta = beta
         self.mu = mu
-        self.precipitation = self.model.f_matrix[self.unique_id][self.unique_id]
-        self.sheet = [[0,0,-10000]]  # self.sheet is a record of [x, mu, benefit] for every successful transaction
+        self.precipitation = self.model.basin.precipitation[self.unique_id]
+        self.sheet = Sheet([0, 0, -10000], tol=self.model.sheet_tol)  # self.sheet is a record of [x, mu, benefit] for every successful transaction
         self.time = 0
+        # counters of the sampler over all learn() calls, see sampler.acceptance_rate
+        self.learn_stats = {'calls': 0, 'iterations': 0, 'accepted': 0, 'exhausted': 0}
 
     def balance(self):
         # water_balance holds true
-        self.water_table()  # calculate the water table to start the computation
+        # the water table (inflow, outflow and the water use limit) is kept up to date by the basin
         choice_num = len(self.out_link)
+        basin = self.model.basin
         while self.x > self.limit:
-            ratio = np.random.uniform(0.5, 1)
+            ratio = self.stream.uniform(0.5, 1)
             # If water use exceeds its net flow_in
             # or there is no out_link, water use should be decreased
-            if self.x > np.sum(self.inflow) + self.store or choice_num == 0:  # self.inflow contains the precipitation
+            if self.x > basin.inflow_sum[self.unique_id] + self.precipitation + self.store or choice_num == 0:
                 self.x = self.x * ratio
             # Else, decrease the outflow to random out_links
             else:
-                d = np.random.randint(0, choice_num, 1)
-                self.outflow[d - 1] = self.outflow[d - 1] * ratio
-                # re-calculate the water table
-            self.water_table()
-
-    def water_table(self):  # water table set a constraint for water use x
-        self.outflow = self.model.f_matrix[self.unique_id]  # array of outflow, including the flow from i to i
-        self.inflow = self.model.f_matrix.transpose()[self.unique_id]
-        self.limit = np.sum(self.inflow) - np.sum(self.outflow) + self.store + self.precipitation  # water use limit
-
-    def outflow_initialize(self):  # decide the outflow based on the minimum flow constraints
-        n = self.out_link.shape[0]  # the number of out_links
-        if n == 0:
-            pass
-        else:
-            outflow_sum = np.sum(self.inflow) + self.store - self.x
-            if outflow_sum < 0:
-                self.x = np.sum(self.inflow) + self.store
-            else:
-                min_sum = np.sum(self.out_min)
-                if min_sum > 0:
-                    for link in self.out_link:
-                        q = self.out_min[link]*outflow_sum/min_sum
-                        self.outflow[link] = q
-                        self.model.f_matrix[self.unique_id][link] = q
-                else:
-                    q_avg = outflow_sum/n
-                    for link in self.out_link:
-                        self.outflow[link] = q_avg
-                        self.model.f_matrix[self.unique_id][link] = q_avg
-
-    def benefit_table(self, price, amount):
-        # utility brought by the use of water
-        u = self.u_a * self.x ** 2 + self.u_b * self.x + self.u_c
-        # transaction income/cost (here, we all use 'income', which is negative for buyers)
-        # Note: a_matrix[i][j] is positive if i is the buyer and j is the seller
-        income = -np.sum(price*amount)
-        income = income - w*np.sum(price*np.abs(amount))
-        # penalty caused by the violation of minimum outflow
-        delta = self.outflow-self.out_min
-        f = self.penalty*delta
-        fine_min = np.sum(f[f<0])
-        # penalty caused by the excess water use
-        fine_excess = excess_fee*max(0, self.x-self.permit-np.sum(amount))
-        # calculate the net benefit
-        self.benefit = u + income + fine_min + fine_excess
-        # if the transaction happens and the , record it into the agent's sheet
-        if np.sum(amount) == self.x-self.permit:
-            self.sheet_up()
-
-    def role_choose(self):
-        x = self.x
-        q = self.permit
-        if x > q:  # water use > permit
-            self.market_role = 'buyer'
-        elif x < q:
-            self.market_role = 'seller'
-        else:
-            self.market_role = 'sider'
-
-    def buy(self):
-        self.bid_amount = self.x - self.permit
-        self.reservation_price = self.res / (1+w)
-        self.bid_price = (1 - self.mu) * self.reservation_price  # mu is in (0, 1)
-
-    def sell(self):
-        self.bid_amount = self.permit - self.x
-        self.reservation_price = self.res / (1 - w)
-        self.bid_price = (1 + self.mu) * self.reservation_price  # mu is in (0, infinity)
-
-    def label_choose(self):
-        if self.limit < self.permit:
-            self.label = 'over'  # there are some water permits which can't be used
-            # under water balance (use <= limit), 'over' user must be a seller
-        else:
-            self.label = 'normal'
+                d = self.stream.integers(0, choice_num)
+                self.set_outflow(d - 1, self.outflow[d - 1] * ratio)
+
+    # water table set a constraint for water use x: limit = inflow - outflow + store + precipitation,
+    # the basin adjusts it whenever a flow changes (see Basin.set_flows)
+    @property
+    def outflow(self):  # array of outflow on each out_link (a read-only view)
+        outflow = self.model.basin.flow[self.model.basin.out_slice(self.unique_id)]
+        outflow.flags.writeable = False
+        return outflow
+
+    @property
+    def inflow(self):  # array of inflow on each in_link
+        return self.model.basin.flow[self.model.basin.in_index(self.unique_id)]
+
+    def set_outflow(self, k, value):  # set the outflow on the out_links k (positions in out_link)
+        basin = self.model.basin
+        edges = np.arange(basin.out_ptr[self.unique_id], basin.out_ptr[self.unique_id+1])[k]
+        basin.set_flows(edges, value)
 
     # learn the outflow, water use and outflow
-    def learn(self):
-        self.x, self.mu = metropolis_hastings(self)
-        self.balance()
-
-    # learn the price
-    def learn_price(self, tau):
-        if self.market_role == 'buyer':
-            mu = min(self.mu - self.beta * (tau - self.bid_price) / self.reservation_price, 1)
-            mu = max(mu, 0)
-            self.mu = mu
-        else:
-            self.mu = max(self.mu + self.beta * (tau - self.bid_price) / self.reservation_price, 0)
-
-    def learn_by_random(self):
-        ratio = np.random.uniform(0.5, 1)
-        self.mu = self.mu * ratio
+    # sample is the (x, mu) drawn for the user if it has been learned in a batch
+    def learn(self, sample=None):
+        if sample is None:
+            x, mu = learn_sample([self], self.model)
+            sample = (x[0], mu[0])
+        self.x, self.mu = sample
+        self.model.schedule.balance([self.unique_id])  # with the balance mode of the model
 
     def sheet_up(self):
         self.sheet.append([self.x, self.mu, self.benefit])
-
-    def propensity_initialization(self):
-        if self.market_role == 'buyer':
-            self.p_ini = 1/(self.limit)
-        else:
-            self.p_ini = 1/(10*self.limit)
-
-    def step(self):
-        self.water_table()  # calculate the outflow, the inflow, the water use limit
-        self.balance()  # check if the water balance holds; if not, re-balance the water table
-        self.role_choose()  # choose the role in the market for the water user
-        if self.market_role == 'buyer':
-            self.buy()
-        elif self.market_role == 'seller':
-            self.sell()
-        else:
-            pass
-        # initialize the propensity
-        if self.time == 0:
-            self.propensity_initialization()
-        self.label_choose()  # choose the label for the water user
-        self.time += 1
-
-    def advance(self):
-        pass
@@ -0,0 +1,292 @@
+from collections import deque
+import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
+
+
+def edge_values(matrix, src, dst):
+    # values of a dense or sparse n x n matrix on the edges (src, dst)
+    if matrix is None:
+        return np.zeros(src.shape[0])
+    if isinstance(matrix, np.ndarray):
+        return matrix[src, dst].astype(float)
+    return np.asarray(csr_matrix(matrix)[src, dst], dtype=float).ravel()
+
+
+def water_fill(seg, value, low, cap):
+    # euclidean projection of value onto {v >= low, sum of v over every segment <= cap} with one shift per
+    # segment: v = max(value - lam, low), found exactly by sorting the breakpoints value - low of the segments
+    # seg must be sorted and sum(low) <= cap on every segment, segments already within cap are left as they are
+    k = cap.shape[0]
+    total = np.bincount(seg, weights=value, minlength=k)
+    over = total[seg] > cap[seg]
+    out = np.array(value, dtype=float)
+    if not np.any(over):
+        return out
+    seg, value, low = seg[over], value[over], low[over]
+    c = value-low
+    order = np.lexsort((c, seg))
+    seg, value, low, c = seg[order], value[order], low[order], c[order]
+    start = np.searchsorted(seg, np.arange(k))
+    m = np.bincount(seg, minlength=k)
+    pos = np.arange(seg.shape[0]) - start[seg]
+    low_cum = np.cumsum(low)
+    low_cum -= (low_cum-low)[start[seg]]
+    value_cum = np.cumsum(value)
+    value_cum -= (value_cum-value)[start[seg]]
+    rest = total[seg]-value_cum  # sum of the values after every entry of its segment
+    # g(c) = sum(max(value - c, low)) at every breakpoint, decreasing along the segment
+    g = low_cum + rest - (m[seg]-pos-1)*c
+    first = np.full(k, seg.shape[0])
+    hit = g <= cap[seg]
+    np.minimum.at(first, seg[hit], np.arange(seg.shape[0])[hit])
+    f = first[seg]  # the first breakpoint where the segment is within cap, the entries from it on are active
+    lam = (low_cum[f]-low[f] + rest[f]+value[f] - cap[seg])/(m[seg]-pos[f])
+    out[np.nonzero(over)[0][order]] = np.maximum(value-lam, low)
+    return out
+
+
+class Basin:
+    # the waterways of the basin as a directed graph in CSR form, with flows, minimum flows and penalties
+    # stored per edge, so the memory is O(edges)
+    # basin_matrix (dense or scipy.sparse): basin_matrix[i][j] != 0 (i != j) is a waterway from i to j,
+    # basin_matrix[i][i] is the local water available of i
+
+    def __init__(self, basin_matrix, precipitation, out_min, penalty):
+        m = coo_matrix(basin_matrix, dtype=float)
+        self.n = m.shape[0]
+        self.store = m.diagonal()
+        edge = (m.row != m.col) & (m.data != 0)
+        m = csr_matrix((np.ones(np.sum(edge)), (m.row[edge], m.col[edge])), shape=m.shape)
+        m.sum_duplicates()
+        m.sort_indices()
+        # out-edges of user i are the edges out_ptr[i]:out_ptr[i+1]
+        self.out_ptr = m.indptr.astype(int)
+        self.dst = m.indices.astype(int)
+        self.src = np.repeat(np.arange(self.n), np.diff(self.out_ptr))
+        # in-edges of user i are the edges in_edges[in_ptr[i]:in_ptr[i+1]]
+        self.in_edges = np.argsort(self.dst, kind='stable')
+        self.in_ptr = np.searchsorted(self.dst[self.in_edges], np.arange(self.n+1), side='left')
+        self.out_min = edge_values(out_min, self.src, self.dst)  # the minimum flow on every edge
+        self.penalty = edge_values(penalty, self.src, self.dst)
+        self.flow = np.zeros(self.src.shape[0])  # the flow on every edge
+        self.precipitation = np.asarray(precipitation, dtype=float)
+        # water table of every user, adjusted in O(degree) whenever flows change
+        self.inflow_sum = np.zeros(self.n)
+        self.outflow_sum = np.zeros(self.n)
+        self.limit = np.zeros(self.n)  # water use limit, shared with the state of the model
+        self.dirty = None  # the dirty flags of the state of the model, the users whose flows or x change are marked
+        self.refresh()
+        self.topological_levels()
+        # the reachability index is built by the first call to reaches() or sources(), which only the pruned and
+        # network-flow markets make, so the other models never pay for it
+        self.indexed = False
+        self.upstream = None
+        self.pre = None
+        self.post = None
+
+    def refresh(self, limit=None):
+        # recompute the water table from the flows, writing the limits into the given array
+        if limit is not None:
+            self.limit = limit
+        self.inflow_sum[:] = np.bincount(self.dst, weights=self.flow, minlength=self.n)
+        self.outflow_sum[:] = np.bincount(self.src, weights=self.flow, minlength=self.n)
+        self.limit[:] = self.inflow_sum - self.outflow_sum + self.store + self.precipitation
+
+    def set_flows(self, edges, value):
+        # set the flow on the edges and adjust the water table of both ends of every edge
+        edges = np.asarray(edges, dtype=int).reshape(-1)
+        value = np.broadcast_to(np.asarray(value, dtype=float), edges.shape)
+        delta = value - self.flow[edges]
+        self.flow[edges] = value
+        np.add.at(self.outflow_sum, self.src[edges], delta)
+        np.add.at(self.inflow_sum, self.dst[edges], delta)
+        np.subtract.at(self.limit, self.src[edges], delta)
+        np.add.at(self.limit, self.dst[edges], delta)
+        if self.dirty is not None:
+            changed = edges[delta != 0]
+            self.dirty[self.src[changed]] = True
+            self.dirty[self.dst[changed]] = True
+
+    def topological_levels(self):
+        # users sorted into levels so that every waterway goes from a lower level to a higher one,
+        # computed once; the out-edges of the users of every level and the share of the outflow
+        # of their user that goes to every edge (proportional to out_min, or even) are kept for routing
+        degree = np.bincount(self.dst, minlength=self.n)
+        level = np.nonzero(degree == 0)[0]
+        self.levels = []
+        self.level_edges = []
+        self.level_owner = []  # position in its level of the user of every edge
+        seen = 0
+        while level.shape[0] > 0:
+            self.levels.append(level)
+            count = self.out_ptr[level+1]-self.out_ptr[level]
+            edges = np.repeat(self.out_ptr[level]-np.cumsum(count)+count, count) + np.arange(np.sum(count))
+            self.level_edges.append(edges)
+            self.level_owner.append(np.repeat(np.arange(level.shape[0]), count))
+            seen += level.shape[0]
+            np.subtract.at(degree, self.dst[edges], 1)
+            nxt = np.unique(self.dst[edges])
+            level = nxt[degree[nxt] == 0]
+        if seen < self.n:
+            raise ValueError('basin_matrix must be a directed acyclic graph')
+        self.out_degree = np.diff(self.out_ptr)
+        min_sum = np.bincount(self.src, weights=self.out_min, minlength=self.n)
+        self.split = np.where(min_sum[self.src] > 0, self.out_min/np.where(min_sum > 0, min_sum, 1)[self.src],
+                              1/np.maximum(self.out_degree, 1)[self.src])
+
+    def route(self, x):
+        # route the water downstream in one pass over the levels: every user withdraws x, and the rest of
+        # its inflow, precipitation and local water leaves through its out-edges in proportion to out_min
+        # a user who can't withdraw x gets all the water available and sends nothing downstream
+        # x is updated in place
+        for level, edges, owner in zip(self.levels, self.level_edges, self.level_owner):
+            available = self.inflow_sum[level] + self.precipitation[level] + self.store[level]
+            short = (self.out_degree[level] > 0) & (available < x[level])
+            x[level[short]] = available[short]
+            if self.dirty is not None:
+                self.dirty[level[short]] = True
+            rest = np.maximum(available-x[level], 0)
+            self.set_flows(edges, self.split[edges]*rest[owner])
+
+    def project(self, x, users):
+        # deterministic balance of the users: every user over its limit (x > limit) gets the nearest (x, outflow)
+        # which meets x + outflow = inflow + precipitation + store, with nothing increased, the outflows kept
+        # at least at out_min when the water allows it, and at least 0 otherwise
+        # x is updated in place, users are distinct unique_id with no waterway between them (e.g. one level)
+        users = np.asarray(users, dtype=int).reshape(-1)
+        users = users[x[users] > self.limit[users]]
+        if users.shape[0] == 0:
+            return
+        count = self.out_degree[users]
+        edges = np.repeat(self.out_ptr[users]-np.cumsum(count)+count, count) + np.arange(np.sum(count))
+        owner = np.repeat(np.arange(users.shape[0]), count)
+        cap = self.inflow_sum[users] + self.precipitation[users] + self.store[users]
+        flow = self.flow[edges]
+        low = np.minimum(flow, self.out_min[edges])
+        short = np.bincount(owner, weights=low, minlength=users.shape[0]) > cap
+        low[short[owner]] = 0
+        seg = np.concatenate((np.arange(users.shape[0]), owner))
+        order = np.argsort(seg, kind='stable')
+        value = np.concatenate((x[users], flow))[order]
+        low = np.concatenate((np.zeros(users.shape[0]), low))[order]
+        v = np.empty(seg.shape[0])
+        v[order] = water_fill(seg[order], value, low, cap)
+        self.set_flows(edges, v[users.shape[0]:])
+        x[users] = np.minimum(v[:users.shape[0]], self.limit[users])
+        if self.dirty is not None:
+            self.dirty[users] = True
+
+    def balance(self, x):
+        # project all the users over their limit, level by level downstream, since cutting an outflow
+        # lowers the limit of the user below
+        for level in self.levels:
+            self.project(x, level)
+
+    def reachability(self):
+        # index telling in O(1) whether the water of a user can flow to another one, built once on first use:
+        # if every user has at most one out-edge the basin is a forest of tributaries and a user reaches
+        # exactly its ancestors towards the outlet, labelled by the intervals of a depth-first search
+        # from the outlets along the in-edges, so the users upstream of v are the ones with pre in [pre[v], post[v]];
+        # otherwise the users upstream of every user are kept as a bit row (n^2/8 bytes)
+        if np.max(self.out_degree, initial=0) <= 1:
+            self.upstream = None
+            self.pre = np.zeros(self.n, dtype=int)
+            self.post = np.zeros(self.n, dtype=int)
+            clock = 0
+            for root in np.nonzero(self.out_degree == 0)[0]:
+                stack = [(root, False)]
+                while stack:
+                    i, done = stack.pop()
+                    if done:
+                        self.post[i] = clock
+                        clock += 1
+                        continue
+                    self.pre[i] = clock
+                    clock += 1
+                    stack.append((i, True))
+                    stack.extend((j, False) for j in self.in_link(i))
+        else:
+            upstream = np.zeros((self.n, (self.n+7)//8), dtype=np.uint8)
+            upstream[np.arange(self.n), np.arange(self.n) >> 3] = 1 << (7 - (np.arange(self.n) & 7))
+            for edges in self.level_edges:  # the rows of the sources of a level are complete when it is reached
+                np.bitwise_or.at(upstream, self.dst[edges], upstream[self.src[edges]])
+            self.upstream = upstream
+        self.indexed = True
+
+    def reaches(self, u, v):
+        # True where the water of u can flow to v (u reaches itself), u and v broadcast against each other
+        u, v = np.broadcast_arrays(np.asarray(u, dtype=int), np.asarray(v, dtype=int))
+        if not self.indexed:
+            self.reachability()
+        if self.upstream is None:
+            return (self.pre[v] <= self.pre[u]) & (self.post[u] <= self.post[v])
+        return (self.upstream[v, u >> 3] >> (7 - (u & 7))) & 1 == 1
+
+    def sources(self, users, targets):
+        # the users whose water can reach every target, as (ptr, idx): the positions in users of the ones
+        # reaching targets[k] are idx[ptr[k]:ptr[k+1]]; the cost grows with the pairs found, not with
+        # len(users) * len(targets), apart from n/8 bytes per target for a basin kept as bit rows
+        users = np.asarray(users, dtype=int)
+        targets = np.asarray(targets, dtype=int)
+        if not self.indexed:
+            self.reachability()
+        if self.upstream is None:
+            order = np.argsort(self.pre[users], kind='stable')
+            key = self.pre[users][order]
+            lo = np.searchsorted(key, self.pre[targets], side='left')
+            hi = np.searchsorted(key, self.post[targets], side='right')
+            count = hi-lo
+            ptr = np.concatenate(([0], np.cumsum(count)))
+            idx = order[np.repeat(lo-ptr[:-1], count) + np.arange(ptr[-1])]
+            return ptr, idx
+        member = np.zeros(self.n, dtype=bool)
+        member[users] = True
+        mask = np.packbits(member)
+        position = np.full(self.n, -1)
+        position[users] = np.arange(users.shape[0])
+        ptr = [0]
+        idx = []
+        for t in targets:
+            hits = self.upstream[t] & mask
+            full = np.flatnonzero(hits)
+            bits = np.unpackbits(hits[full]).reshape(-1, 8).astype(bool)
+            found = position[(full[:, None]*8 + np.arange(8))[bits]]
+            idx.append(found)
+            ptr.append(ptr[-1] + found.shape[0])
+        return np.array(ptr), np.concatenate(idx) if idx else np.zeros(0, dtype=int)
+
+    def neighbors(self, k):
+        # the k users nearest to every user by the number of waterways among the ones upstream of it, whose water
+        # can reach it, as an (n, k) array padded with -1, found by a breadth-first search stopped after k users
+        neighbor = np.full((self.n, k), -1)
+        for i in range(self.n):
+            queue = deque(self.in_link(i))
+            seen = {i}
+            found = 0
+            while queue and found < k:
+                j = queue.popleft()
+                if j in seen:
+                    continue
+                seen.add(j)
+                neighbor[i, found] = j
+                found += 1
+                queue.extend(self.in_link(j))
+        return neighbor
+
+    def out_slice(self, i):
+        return slice(self.out_ptr[i], self.out_ptr[i+1])
+
+    def in_index(self, i):
+        return self.in_edges[self.in_ptr[i]:self.in_ptr[i+1]]
+
+    def out_link(self, i):  # the users downstream of i
+        return self.dst[self.out_slice(i)]
+
+    def in_link(self, i):  # the users upstream of i
+        return self.src[self.in_index(i)]
+
+    def flow_matrix(self):
+        # dense view, f_matrix[i][j] is the flow from agent i to agent j and f_matrix[i][i] the precipitation
+        f = np.diag(self.precipitation)
+        f[self.src, self.dst] = self.flow
+        return f
@@ -0,0 +1,138 @@
+import time
+import numpy as np
+from scipy.sparse import coo_matrix
+from sheet import Sheet
+from streams import Stream, spawn
+from sampler import metropolis_hastings_batch, grid_sample
+from state import BUYER
+from clearing import discriminatory_price, uniform_price
+from WaterMarket import WaterMarket
+
+
+class BenchUser:
+    # the attributes of a WaterUser the learning samplers read, with a synthetic sheet
+
+    def __init__(self, seed, rows, limit, market_role):
+        self.stream = Stream(seed)
+        self.sheet = Sheet([0, 0, -10000])
+        for row in rows:
+            self.sheet.append(row)
+        self.limit = limit
+        self.market_role = market_role
+        self.x = 0.5*limit
+        self.mu = 0.5
+        if market_role == BUYER:
+            self.p_ini = 1/limit
+        else:
+            self.p_ini = 1/(10*limit)
+        self.learn_stats = {'calls': 0, 'iterations': 0, 'accepted': 0, 'exhausted': 0}
+
+
+def bench_users(n, draws, seed=0):
+    # n users with a sheet of draws records around a clear optimum
+    rng = np.random.default_rng(seed)
+    seeds = spawn(seed, n)
+    users = []
+    for i in range(0, n):
+        limit = rng.uniform(1, 3)
+        x = np.clip(rng.normal(0.6*limit, 0.2, draws), 0.05, limit)
+        mu = np.clip(rng.normal(0.4, 0.1, draws), 0, 1)
+        benefit = 100 - 50*(x-0.6*limit)**2 - 20*(mu-0.4)**2
+        users.append(BenchUser(seeds[i], np.column_stack((x, mu, benefit)), limit, BUYER))
+    return users
+
+
+def histogram_distance(a, b, limit, bins=8):
+    # total variation distance between the 2-d histograms of two sets of (x, mu) draws
+    edges = (np.linspace(0, limit, bins+1), np.linspace(0, 1, bins+1))
+    h_a = np.histogram2d(a[0], a[1], bins=edges)[0]
+    h_b = np.histogram2d(b[0], b[1], bins=edges)[0]
+    return 0.5*np.sum(np.abs(h_a/np.sum(h_a)-h_b/np.sum(h_b)))
+
+
+def bench_learning(samples=300, draws=50, sizes=(16, 64, 128)):
+    # speed and distribution of the adaptive proposal and of the grid learning mode against the
+    # 10,000-step metropolis_hastings burn-in, every MH draw burns in from scratch as a learn() call after a trade does
+    user = bench_users(1, draws)[0]
+    t = time.perf_counter()
+    mh = np.zeros((2, samples))
+    for s in range(0, samples):
+        user.sheet.memo = {}
+        x, mu = metropolis_hastings_batch([user])
+        mh[:, s] = x[0], mu[0]
+    t_mh = (time.perf_counter()-t)/samples
+    print('mh          %6.3f ms/draw  x %.3f (%.3f)  mu %.3f (%.3f)'
+          % (1000*t_mh, np.mean(mh[0]), np.std(mh[0]), np.mean(mh[1]), np.std(mh[1])))
+    t = time.perf_counter()
+    walk = np.zeros((2, samples))
+    for s in range(0, samples):
+        user.sheet.memo = {}
+        x, mu = metropolis_hastings_batch([user], proposal='adaptive')
+        walk[:, s] = x[0], mu[0]
+    t_walk = (time.perf_counter()-t)/samples
+    print('mh adaptive %6.3f ms/draw  x %.3f (%.3f)  mu %.3f (%.3f)  distance to mh %.3f'
+          % (1000*t_walk, np.mean(walk[0]), np.std(walk[0]), np.mean(walk[1]), np.std(walk[1]),
+             histogram_distance(mh, walk, user.limit)))
+    half = samples // 2  # the distance between two halves of the MH draws is the noise floor of the comparison
+    print('distance between halves of the mh draws %.3f' % histogram_distance(mh[:, :half], mh[:, half:], user.limit))
+    for size in sizes:
+        t = time.perf_counter()
+        grid = np.zeros((2, samples))
+        for s in range(0, samples):
+            user.sheet.memo = {}
+            x, mu = grid_sample([user], size)
+            grid[:, s] = x[0], mu[0]
+        t_grid = (time.perf_counter()-t)/samples
+        print('grid %3d    %6.3f ms/draw  x %.3f (%.3f)  mu %.3f (%.3f)  distance to mh %.3f'
+              % (size, 1000*t_grid, np.mean(grid[0]), np.std(grid[0]), np.mean(grid[1]), np.std(grid[1]),
+                 histogram_distance(mh, grid, user.limit)))
+
+
+def bench_clearing(sizes=(10, 1000, 100000), repeat=5, seed=0):
+    # clearing time of the uniform-price call auction against the discriminatory-price double auction,
+    # with half of the agents buying and half selling around the same prices
+    rng = np.random.default_rng(seed)
+    for n in sizes:
+        k = n // 2
+        bids = (rng.uniform(1, 3, k), rng.uniform(0, 1, k), rng.uniform(1, 3, n-k), rng.uniform(0, 1, n-k))
+        for name, clear in (('discriminatory', discriminatory_price), ('uniform', uniform_price)):
+            t = time.perf_counter()
+            for r in range(0, repeat):
+                b, s, price, amount = clear(*bids)
+            t_clear = (time.perf_counter()-t)/repeat
+            print('%-14s %7d agents  %9.3f ms  %6d trades  volume %.3f'
+                  % (name, n, 1000*t_clear, b.shape[0], np.sum(amount)))
+
+
+def bench_market(n, seed=0, **kwargs):
+    # a market of n users on a random tree basin, every user flowing to one of the next 20 users
+    rng = np.random.default_rng(seed)
+    src = np.arange(0, n-1)
+    dst = np.array([rng.integers(j+1, min(n, j+20)) for j in src])
+
+    def edges(value):  # a sparse n x n matrix with value on the waterways
+        return coo_matrix((value, (src, dst)), shape=(n, n))
+
+    u = np.column_stack((rng.uniform(-0.3, -0.05, n), rng.uniform(2, 8, n), rng.uniform(-20, 0, n)))
+    return WaterMarket(basin_matrix=edges(np.ones(n-1)), precipitation=rng.uniform(0, 100, n),
+                       out_min=edges(rng.uniform(0, 5, n-1)), penalty=edges(np.full(n-1, 15.0)),
+                       res=rng.uniform(15, 45, n), u=u, water_permit=rng.uniform(10, 50, n),
+                       beta=np.full(n, 0.2), mu=np.full(n, 0.1), market='discriminatory-price', seed=seed, **kwargs)
+
+
+def bench_pool(n=400, steps=6, workers=(None, 2, 4)):
+    # step time of a market learning in the main process against a learning pool of some workers,
+    # the pooled runs draw the same strategies whatever the number of workers
+    for count in workers:
+        with bench_market(n, learn_workers=count) as model:
+            t = time.perf_counter()
+            for k in range(0, steps):
+                model.step()
+            t_step = (time.perf_counter()-t)/steps
+        print('workers %-4s %7.3f s/step  mean x %.6f' % (count, t_step, np.mean(model.x)))
+
+
+if __name__ == '__main__':
+    bench_learning()
+    bench_clearing()
+    bench_pool()
@@ -0,0 +1,150 @@
+import numpy as np
+from scipy.optimize import linprog
+from scipy.sparse import coo_matrix, vstack
+
+
+def match(buyer_price, buyer_amount, seller_price, seller_amount):
+    # match a double auction: buyers sorted by their price offers in descending order, sellers in ascending
+    # order, and the volumes are matched along the cumulative sums of both sides
+    # returns the positions of the buyers and the sellers in the given arrays and the amount of every fill
+    empty = np.zeros(0, dtype=int)
+    if buyer_price.shape[0] == 0 or seller_price.shape[0] == 0:
+        return empty, empty, np.zeros(0)
+    buyer_order = np.argsort(-buyer_price, kind='stable')
+    seller_order = np.argsort(seller_price, kind='stable')
+    buyer_cum = np.cumsum(buyer_amount[buyer_order])
+    seller_cum = np.cumsum(seller_amount[seller_order])
+    total = min(buyer_cum[-1], seller_cum[-1])
+    # every segment between two consecutive cumulative volumes is filled by one buyer and one seller
+    edges = np.union1d(buyer_cum[buyer_cum < total], seller_cum[seller_cum < total])
+    edges = np.append(edges[edges > 0], total)
+    amount = np.diff(edges, prepend=0)
+    b = np.minimum(np.searchsorted(buyer_cum, edges, side='left'), buyer_order.shape[0]-1)
+    s = np.minimum(np.searchsorted(seller_cum, edges, side='left'), seller_order.shape[0]-1)
+    b = buyer_order[b]
+    s = seller_order[s]
+    # buyer prices decrease and seller prices increase along the segments, so the trades are a prefix
+    fail = np.nonzero(buyer_price[b] <= seller_price[s])[0]
+    n = fail[0] if fail.shape[0] > 0 else edges.shape[0]
+    keep = amount[:n] > 1e-12*max(1.0, total)
+    return b[:n][keep], s[:n][keep], amount[:n][keep]
+
+
+def pruned_match(buyer_price, buyer_amount, seller_price, seller_amount, candidates):
+    # match with only the pairs in candidates able to trade, candidates = (ptr, idx) lists the positions of the
+    # sellers buyer b may trade with as idx[ptr[b]:ptr[b+1]] (see Basin.sources): buyers in descending order
+    # of their price offers take the cheapest volumes left among their candidates, as long as the seller asks
+    # less (with every pair a candidate this is the same matching as match())
+    empty = np.zeros(0, dtype=int)
+    if buyer_price.shape[0] == 0 or seller_price.shape[0] == 0:
+        return empty, empty, np.zeros(0)
+    ptr, idx = candidates
+    rank = np.empty(seller_price.shape[0], dtype=int)  # position of every seller in ascending order of price
+    rank[np.argsort(seller_price, kind='stable')] = np.arange(seller_price.shape[0])
+    left = np.array(seller_amount, dtype=float)
+    tiny = 1e-12*max(1.0, min(np.sum(buyer_amount), np.sum(seller_amount)))
+    b, s, amount = [], [], []
+    for i in np.argsort(-buyer_price, kind='stable'):
+        c = idx[ptr[i]:ptr[i+1]]
+        c = c[(seller_price[c] < buyer_price[i]) & (left[c] > 0)]
+        c = c[np.argsort(rank[c])]
+        take = left[c]
+        cum = np.cumsum(take)
+        fill = np.minimum(take, np.maximum(buyer_amount[i]-(cum-take), 0))
+        k = fill > tiny
+        left[c[k]] -= fill[k]
+        b.append(np.full(np.sum(k), i))
+        s.append(c[k])
+        amount.append(fill[k])
+    return np.concatenate(b), np.concatenate(s), np.concatenate(amount)
+
+
+def discriminatory_price(buyer_price, buyer_amount, seller_price, seller_amount, candidates=None):
+    # every matched pair trades at the midpoint of its price offers, candidates restricts the pairs
+    if candidates is None:
+        b, s, amount = match(buyer_price, buyer_amount, seller_price, seller_amount)
+    else:
+        b, s, amount = pruned_match(buyer_price, buyer_amount, seller_price, seller_amount, candidates)
+    return b, s, 0.5*(buyer_price[b]+seller_price[s]), amount
+
+
+def uniform_price(buyer_price, buyer_amount, seller_price, seller_amount):
+    # call auction: the aggregate demand and supply curves are the cumulative sums of match(), all the fills
+    # trade at one clearing price, the midpoint of the offers of the marginal (last matched) buyer and seller,
+    # which every matched buyer offers at least and every matched seller asks at most
+    b, s, amount = match(buyer_price, buyer_amount, seller_price, seller_amount)
+    if b.shape[0] == 0:
+        return b, s, np.zeros(0), amount
+    return b, s, np.full(b.shape[0], 0.5*(buyer_price[b[-1]]+seller_price[s[-1]])), amount
+
+
+def network_flow(basin, use, buyer, buyer_price, buyer_amount, seller, seller_price, seller_amount,
+                 pair_b, pair_s):
+    # clear the market and route the water in one linear program on the basin graph:
+    # - trades t on the allowed pairs (buyer[pair_b], seller[pair_s]) up to the bid amounts of both sides,
+    #   earning buyer_price - seller_price per unit
+    # - flows f on every edge, with a shortfall d below out_min costing its penalty per unit
+    # - every user uses use - r, where the shortage r is cut from its water use at a cost above any gain,
+    #   and the water it doesn't use leaves through its out-edges (a user with no out-edge may leave water
+    #   unused); a buyer's purchases and shortage together stay within its bid amount, so it doesn't buy
+    #   permits for water it can't get, and the demand left unmatched is still used (and fined as excess)
+    # returns the pairs and the amounts traded, the flows and the water use of every user
+    n, k, e = basin.n, pair_b.shape[0], basin.src.shape[0]
+    gain = buyer_price[pair_b] - seller_price[pair_s]
+    cost = 10*(1 + np.max(np.abs(gain), initial=0) + np.max(basin.penalty, initial=0))
+    # the variables are [t (k), f (e), d (e), r (n)]
+    c = np.concatenate((-gain, np.zeros(e), basin.penalty, np.full(n, cost)))
+    t, f, d, r = np.arange(k), k + np.arange(e), k + e + np.arange(e), k + 2*e + np.arange(n)
+    # water balance of every user: - r + outflow - inflow (= or <=) precipitation + store - use
+    rows = np.concatenate((np.arange(n), basin.src, basin.dst))
+    cols = np.concatenate((r, f, f))
+    vals = np.concatenate((-np.ones(n), np.ones(e), -np.ones(e)))
+    balance = coo_matrix((vals, (rows, cols)), shape=(n, c.shape[0])).tocsr()
+    rhs = basin.precipitation + basin.store - use
+    source = basin.out_degree > 0
+    # bid amounts of both sides (bought + r for the buyers), and f + d >= out_min
+    m_b, m_s = buyer.shape[0], seller.shape[0]
+    rows = np.concatenate((pair_b, np.arange(m_b), m_b + pair_s, m_b + m_s + np.arange(e), m_b + m_s + np.arange(e)))
+    cols = np.concatenate((t, r[buyer], t, f, d))
+    vals = np.concatenate((np.ones(2*k + m_b), -np.ones(2*e)))
+    bound = coo_matrix((vals, (rows, cols)), shape=(m_b + m_s + e, c.shape[0])).tocsr()
+    a_ub = np.concatenate((buyer_amount, seller_amount, -basin.out_min))
+    result = linprog(c, A_ub=vstack((bound, balance[~source])), b_ub=np.concatenate((a_ub, rhs[~source])),
+                     A_eq=balance[source], b_eq=rhs[source],
+                     bounds=np.concatenate((np.column_stack((np.zeros(k+e), np.full(k+e, np.inf))),
+                                            np.column_stack((np.zeros(e), basin.out_min)),
+                                            np.column_stack((np.zeros(n), np.maximum(use, 0))))),
+                     method='highs')
+    if result.status != 0:
+        raise ValueError('network-flow clearing failed: ' + result.message)
+    x = np.maximum(result.x, 0)
+    trade = np.nonzero(x[t] > 1e-12)[0]
+    return pair_b[trade], pair_s[trade], x[t][trade], x[f], use - x[r]
+
+
+def bilateral(order, neighbor, seller, price, amount):
+    # bilateral negotiations: the buyers in the given order each negotiate with their candidate partners
+    # neighbor[buyer] (padded with -1, users whose water can reach the buyer, see Basin.neighbors) who are
+    # sellers (seller[j] is True) asking less than the buyer offers, the cheapest first, until the buyer's
+    # amount is met; every pair trades at the midpoint of its offers
+    # price and amount are the bids of all the users, the work is O(len(order) * neighbor.shape[1])
+    left = np.where(seller, amount, 0.0)
+    tiny = 1e-12*max(1.0, np.sum(left))
+    b, s, volume = [], [], []
+    for i in order:
+        c = neighbor[i]
+        c = c[c >= 0]
+        c = c[seller[c] & (price[c] < price[i]) & (left[c] > 0)]
+        c = c[np.argsort(price[c], kind='stable')]
+        take = left[c]
+        cum = np.cumsum(take)
+        fill = np.minimum(take, np.maximum(amount[i]-(cum-take), 0))
+        k = fill > tiny
+        left[c[k]] -= fill[k]
+        b.append(np.full(np.sum(k), i))
+        s.append(c[k])
+        volume.append(fill[k])
+    if len(b) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+    b, s, volume = np.concatenate(b), np.concatenate(s), np.concatenate(volume)
+    return b, s, 0.5*(price[b]+price[s]), volume
@@ -0,0 +1,45 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+
+
+class Ledger:
+    # trades of a market step in COO form: buyer, seller, price and amount of every trade
+    # dense views (the former p_matrix and a_matrix) are built only when asked for
+
+    def __init__(self, n, buyer=None, seller=None, price=None, amount=None):
+        self.n = n  # number of users
+        self.buyer = np.zeros(0, dtype=int) if buyer is None else np.asarray(buyer, dtype=int)
+        self.seller = np.zeros(0, dtype=int) if seller is None else np.asarray(seller, dtype=int)
+        self.price = np.zeros(0) if price is None else np.asarray(price, dtype=float)
+        self.amount = np.zeros(0) if amount is None else np.asarray(amount, dtype=float)
+
+    def __len__(self):
+        return self.buyer.shape[0]
+
+    def sparse_price(self):
+        # p_matrix[i][j] is the transaction price between agent i and agent j, as a sparse matrix
+        rows = np.concatenate((self.buyer, self.seller))
+        cols = np.concatenate((self.seller, self.buyer))
+        return coo_matrix((np.concatenate((self.price, self.price)), (rows, cols)), shape=(self.n, self.n)).tocsr()
+
+    def sparse_amount(self):
+        # a_matrix[i][j] is the transaction amount from agent i to agent j, positive if i is the buyer
+        rows = np.concatenate((self.buyer, self.seller))
+        cols = np.concatenate((self.seller, self.buyer))
+        return coo_matrix((np.concatenate((self.amount, -self.amount)), (rows, cols)), shape=(self.n, self.n)).tocsr()
+
+    def price_matrix(self):
+        return self.sparse_price().toarray()
+
+    def amount_matrix(self):
+        return self.sparse_amount().toarray()
+
+    def price_sum(self):  # sum of the prices of the trades of every user, the row sums of p_matrix
+        return (np.bincount(self.buyer, weights=self.price, minlength=self.n)
+                + np.bincount(self.seller, weights=self.price, minlength=self.n))
+
+    def price_mean(self):  # average price of the trades with a non-zero price, None if there is none
+        price = self.price[self.price != 0]
+        if price.shape[0] == 0:
+            return None
+        return np.mean(price)
@@ -0,0 +1,90 @@
+import heapq
+import numpy as np
+from state import SIDER, BUYER, SELLER
+
+
+class OrderBook:
+    # persistent book of a continuous double auction: one order per user at most, the bids and the asks
+    # in priority heaps (best price first, then the earliest order)
+    # an amended or cancelled order leaves its old heap entry behind, which is skipped when it comes to the top,
+    # so every order event costs O(log n) plus the fills it makes
+    # the ledger of the market covers one step, so at every step the live orders are restored to the current bids:
+    # the volume an order filled in an earlier step is not carried over (see events)
+
+    def __init__(self, n):
+        self.bids = []  # entries (-price, seq, user)
+        self.asks = []  # entries (price, seq, user)
+        self.side = np.zeros(n, dtype=np.int8)  # BUYER, SELLER or SIDER (no order)
+        self.price = np.zeros(n)
+        self.amount = np.zeros(n)  # the amount left in the book
+        self.seq = np.zeros(n, dtype=int)  # sequence number of the live order of every user
+        self.count = 0
+        self.n = n
+
+    def __len__(self):  # number of live orders
+        return int(np.sum((self.side != SIDER) & (self.amount > 0)))
+
+    def live(self, entry, side):
+        user = entry[2]
+        return self.side[user] == side and self.seq[user] == entry[1] and self.amount[user] > 0
+
+    def best(self, heap, side):  # the top live entry of a heap, None if there is none
+        while heap and not self.live(heap[0], side):
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def cancel(self, user):
+        self.side[user] = SIDER
+        self.amount[user] = 0
+
+    def post(self, user, side, price, amount):
+        # post, amend (a new price loses its priority, a new amount keeps it) or cancel (side SIDER) the order
+        # of the user, then match the book; returns the fills as (buyer, seller, price, amount) lists
+        if side == SIDER or amount <= 0:
+            self.cancel(user)
+            return [], [], [], []
+        if side != self.side[user] or price != self.price[user] or self.amount[user] <= 0:
+            self.count += 1
+            self.seq[user] = self.count
+            if side == BUYER:
+                heapq.heappush(self.bids, (-price, self.count, user))
+            else:
+                heapq.heappush(self.asks, (price, self.count, user))
+        self.side[user] = side
+        self.price[user] = price
+        self.amount[user] = amount
+        if len(self.bids) + len(self.asks) > 2*self.n + 64:
+            self.compact()
+        return self.match()
+
+    def compact(self):  # drop the entries left behind, amortized O(1) per order event
+        self.bids = [e for e in self.bids if self.live(e, BUYER)]
+        self.asks = [e for e in self.asks if self.live(e, SELLER)]
+        heapq.heapify(self.bids)
+        heapq.heapify(self.asks)
+
+    def match(self):
+        # fill while the best bid crosses the best ask, at the price of the earlier of the two orders
+        buyer, seller, price, amount = [], [], [], []
+        while True:
+            bid = self.best(self.bids, BUYER)
+            ask = self.best(self.asks, SELLER)
+            if bid is None or ask is None or -bid[0] <= ask[0]:
+                return buyer, seller, price, amount
+            b, s = bid[2], ask[2]
+            fill = min(self.amount[b], self.amount[s])
+            buyer.append(b)
+            seller.append(s)
+            price.append(-bid[0] if bid[1] < ask[1] else ask[0])
+            amount.append(fill)
+            self.amount[b] -= fill
+            self.amount[s] -= fill
+
+    def events(self, side, price, amount):
+        # the users whose order in the book differs from the given bids of all the users, an order partly or fully
+        # filled in an earlier step included, so that its amount is restored to the bid (keeping its priority
+        # if the price is unchanged)
+        live = (self.side != SIDER) & (self.amount > 0)
+        wanted = (side != SIDER) & (amount > 0)
+        return np.nonzero((live != wanted)
+                          | (wanted & ((self.side != side) | (self.price != price) | (self.amount != amount))))[0]
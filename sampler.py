@@ -0,0 +1,359 @@
+import time
+import numpy as np
+from sheet import sheet_terms, evaluate
+from state import BUYER
+from streams import Stream
+
+
+burn_in = 10000  # iterations of the burn-in process
+sample_iter = 100000  # default budget of iterations of the sampling phase
+grid_size = 64  # default number of cells per axis of the grid learning mode
+target_rate = 0.3  # acceptance rate the adaptive proposal is tuned toward
+min_burn_in = 1000  # iterations of the adaptive burn-in before the convergence diagnostic may stop it
+geweke_z = 2.0  # |z| of the geweke diagnostic below which a chain is taken as converged
+block_size = 1000  # proposals drawn and evaluated at a time
+block_cells = 4000000  # upper bound of (agents x proposals x sheet rows) evaluated at a time
+
+
+def mu_limit(user):  # upper bound of the proposal for mu
+    if user.market_role == BUYER:
+        return 1  # mu is in (0, 1)
+    else:
+        return 10  # mu is in (0, infinity)
+
+
+def pack(users):
+    # stack the sheet terms of several users into (k, m) arrays, padded with zero coefficients
+    terms = [sheet_terms(user.sheet) for user in users]
+    m = max([t[0].shape[0] for t in terms] + [1])
+    k = len(users)
+    x_c = np.ones((k, m))
+    mu_c = np.zeros((k, m))
+    coef = np.zeros((k, m))
+    base = np.zeros(k)
+    for i, (xi, mi, ci, decay, folded) in enumerate(terms):
+        x_c[i, :xi.shape[0]] = xi
+        mu_c[i, :mi.shape[0]] = mi
+        coef[i, :ci.shape[0]] = ci
+        base[i] = users[i].p_ini*decay + folded
+    return x_c, mu_c, coef, base
+
+
+def propose(streams, limit, mu_max, b):
+    # independent proposals for x in [0, limit] and mu in [0, mu_max], b for every user,
+    # each user's block is drawn from its own stream
+    k = limit.shape[0]
+    x = np.zeros((k, b))
+    mu = np.zeros((k, b))
+    u = np.zeros((k, b))
+    for i in range(0, k):
+        x[i] = streams[i].truncnorm(0, limit[i], size=b)
+        mu[i] = streams[i].truncnorm(0, mu_max[i], size=b)
+        u[i] = streams[i].random(size=b)
+    return x, mu, u
+
+
+def burn(streams, x, mu, q_t, limit, mu_max, x_c, mu_c, coef, base, b, deadline=None):
+    # burn-in process, q_t is the propensity of the current state and is only updated on acceptance
+    accepted = np.zeros(x.shape[0], dtype=int)
+    done = 0
+    while done < burn_in and not (deadline is not None and time.perf_counter() > deadline):
+        size = min(b, burn_in-done)
+        x_candidate, mu_candidate, u = propose(streams, limit, mu_max, size)
+        q_candidate = evaluate(x_candidate, mu_candidate, x_c, mu_c, coef, base)
+        for t in range(0, size):
+            rate = np.minimum(1, q_candidate[:, t]/q_t)
+            accept = u[:, t] < rate
+            x = np.where(accept, x_candidate[:, t], x)
+            mu = np.where(accept, mu_candidate[:, t], mu)
+            q_t = np.where(accept, q_candidate[:, t], q_t)
+            accepted += accept
+        done += size
+    return x, mu, q_t, done, accepted
+
+
+def propose_walk(streams, x, mu, scale, b):
+    # random-walk proposals around (x, mu) with the per-chain scales of x and mu, b for every user
+    k = x.shape[0]
+    z = np.zeros((k, 2, b))
+    u = np.zeros((k, b))
+    for i in range(0, k):
+        z[i] = streams[i].normal(size=(2, b))
+        u[i] = streams[i].random(size=b)
+    return x[:, None] + scale[:, 0, None]*z[:, 0], mu[:, None] + scale[:, 1, None]*z[:, 1], u
+
+
+def walk_rate(q_candidate, x_candidate, mu_candidate, q_t, x, mu, limit, mu_max):
+    # acceptance rate of a random-walk move; its target is the propensity times the density of the
+    # independence proposal, the stationary distribution of the independence chain, on the same box
+    inside = (x_candidate >= 0) & (x_candidate <= limit) & (mu_candidate >= 0) & (mu_candidate <= mu_max)
+    g = np.exp(-0.5*(x_candidate**2-x**2)-0.5*(mu_candidate**2-mu**2))
+    return np.where(inside, np.minimum(1, q_candidate/q_t*g), 0)
+
+
+def geweke(trace):
+    # z-score of the difference between the means of the first 10% and the last 50% of each row of trace,
+    # the variances of the means are estimated by batch means
+    n = trace.shape[1]
+    z = []
+    for part in (trace[:, :max(n//10, 5)], trace[:, n//2:]):
+        batches = part[:, :part.shape[1]//5*5].reshape(trace.shape[0], 5, -1).mean(axis=2)
+        z.append((part.mean(axis=1), batches.var(axis=1, ddof=1)/5))
+    return (z[0][0]-z[1][0])/np.sqrt(z[0][1]+z[1][1]+1e-300)
+
+
+def burn_walk(streams, x, mu, q_t, limit, mu_max, x_c, mu_c, coef, base, b, deadline=None):
+    # burn-in process of the adaptive random walk: after every block the scales are tuned toward
+    # target_rate, and a chain stops once its last block passes the geweke diagnostic
+    # complete is False for the chains stopped by the deadline before they converged or ran burn_in iterations
+    k = x.shape[0]
+    scale = 0.25*np.column_stack((limit, mu_max))
+    accepted = np.zeros(k, dtype=int)
+    done = np.zeros(k, dtype=int)
+    active = np.arange(k)
+    blocks = 0
+    while active.shape[0] > 0 and not (deadline is not None and time.perf_counter() > deadline):
+        size = min(b, burn_in-done[active[0]])
+        if size <= 0:
+            break
+        a = active
+        x_candidate, mu_candidate, u = propose_walk([streams[i] for i in a], np.zeros(a.shape[0]),
+                                                    np.zeros(a.shape[0]), scale[a], size)
+        trace = np.zeros((a.shape[0], 2, size))
+        hits = np.zeros(a.shape[0], dtype=int)
+        for t in range(0, size):
+            x_t = x[a] + x_candidate[:, t]
+            mu_t = mu[a] + mu_candidate[:, t]
+            q_candidate = evaluate(x_t[:, None], mu_t[:, None], x_c[a], mu_c[a], coef[a], base[a])[:, 0]
+            accept = u[:, t] < walk_rate(q_candidate, x_t, mu_t, q_t[a], x[a], mu[a], limit[a], mu_max[a])
+            x[a] = np.where(accept, x_t, x[a])
+            mu[a] = np.where(accept, mu_t, mu[a])
+            q_t[a] = np.where(accept, q_candidate, q_t[a])
+            hits += accept
+            trace[:, 0, t] = x[a]
+            trace[:, 1, t] = mu[a]
+        accepted[a] += hits
+        done[a] += size
+        blocks += 1
+        scale[a] *= np.exp((hits/size-target_rate)/np.sqrt(blocks))[:, None]
+        converged = (done[a] >= min_burn_in) & (size >= 50)
+        if np.any(converged):
+            converged &= np.all(np.abs(geweke(trace.reshape(-1, size)).reshape(-1, 2)) < geweke_z, axis=1)
+        active = a[~converged]
+    complete = np.ones(k, dtype=bool)
+    complete[active] = False
+    return x, mu, q_t, done, accepted, scale, complete | (done >= burn_in)
+
+
+def draw(streams, x, mu, q_t, limit, mu_max, x_c, mu_c, coef, base, b, max_iter=sample_iter, deadline=None,
+         scale=None):
+    # do sampling: the state is fixed, so the first accepted candidate of every chain is its draw
+    # candidates are independent proposals, or random-walk moves if the scales of the walk are given
+    # a chain which runs out of its iteration or time budget falls back to its current state (x, mu)
+    # returns the new state of every chain with its propensity q_new, which the next draw continues from
+    k = q_t.shape[0]
+    x_new = np.array(x, dtype=float)
+    mu_new = np.array(mu, dtype=float)
+    q_new = np.array(q_t, dtype=float)
+    used = np.zeros(k, dtype=int)
+    hit_any = np.zeros(k, dtype=bool)
+    waiting = np.arange(k)
+    while waiting.shape[0] > 0:
+        size = min(b, max_iter-used[waiting[0]])
+        if size <= 0 or (deadline is not None and time.perf_counter() > deadline):
+            break
+        w = waiting
+        if scale is None:
+            x_candidate, mu_candidate, u = propose([streams[i] for i in w], limit[w], mu_max[w], size)
+        else:
+            x_candidate, mu_candidate, u = propose_walk([streams[i] for i in w], x[w], mu[w], scale[w], size)
+        q_candidate = evaluate(x_candidate, mu_candidate, x_c[w], mu_c[w], coef[w], base[w])
+        if scale is None:
+            accept = u < np.minimum(1, q_candidate/q_t[w, None])
+        else:
+            accept = u < walk_rate(q_candidate, x_candidate, mu_candidate, q_t[w, None], x[w, None], mu[w, None],
+                                   limit[w, None], mu_max[w, None])
+        hit = np.any(accept, axis=1)
+        first = np.argmax(accept, axis=1)
+        used[w] += np.where(hit, first+1, size)
+        rows = np.nonzero(hit)[0]
+        x_new[w[rows]] = x_candidate[rows, first[rows]]
+        mu_new[w[rows]] = mu_candidate[rows, first[rows]]
+        q_new[w[rows]] = q_candidate[rows, first[rows]]
+        hit_any[w[rows]] = True
+        waiting = w[~hit]
+    return x_new, mu_new, q_new, used, hit_any
+
+
+# metropolis_hastings sampling algorithm for a batch of users, all chains advance together
+# max_iter bounds the iterations of the sampling phase and max_time (in seconds) the whole call
+# proposal is 'independence' (truncated normal draws over the whole box) or 'adaptive' (a random walk
+# tuned during the burn-in, which stops early once the chain has converged)
+def metropolis_hastings_batch(users, max_iter=sample_iter, max_time=None, proposal='independence'):
+    k = len(users)
+    if k == 0:
+        return np.zeros(0), np.zeros(0)
+    deadline = None if max_time is None else time.perf_counter() + max_time
+    streams = [user.stream for user in users]
+    x = np.array([user.x for user in users], dtype=float)
+    mu = np.array([user.mu for user in users], dtype=float)
+    limit = np.array([user.limit for user in users], dtype=float)
+    mu_max = np.array([mu_limit(user) for user in users], dtype=float)
+    x_c, mu_c, coef, base = pack(users)
+    b = int(max(1, min(block_size, block_cells // (k*x_c.shape[1]))))
+    q_t = np.zeros(k)
+    scale = np.zeros((k, 2))
+    iterations = np.zeros(k, dtype=int)
+    accepted = np.zeros(k, dtype=int)
+    # a chain whose sheet, proposal and initial propensity are unchanged since the last learn() resumes
+    # from its memorized state, the draw of that call, so the successive draws are the successive moves of
+    # one burned-in chain; the memo is dropped when sheet_up() appends a row
+    fresh = np.ones(k, dtype=bool)
+    burned = np.ones(k, dtype=bool)  # False for the chains whose burn-in the deadline cut short
+    for i in range(0, k):
+        chain = users[i].sheet.memo.get('chain')
+        if chain is not None and chain[4:] == (limit[i], mu_max[i], base[i], proposal):
+            x[i], mu[i], q_t[i], scale[i] = chain[:4]
+            fresh[i] = False
+    f = np.nonzero(fresh)[0]
+    if f.shape[0] > 0:
+        # the propensity of the current state is kept along the chain
+        q_t[f] = evaluate(x[f, None], mu[f, None], x_c[f], mu_c[f], coef[f], base[f])[:, 0]
+        if proposal == 'adaptive':
+            x[f], mu[f], q_t[f], iterations[f], accepted[f], scale[f], burned[f] = burn_walk(
+                [streams[i] for i in f], x[f], mu[f], q_t[f], limit[f], mu_max[f],
+                x_c[f], mu_c[f], coef[f], base[f], b, deadline)
+        else:
+            x[f], mu[f], q_t[f], iterations[f], accepted[f] = burn(
+                [streams[i] for i in f], x[f], mu[f], q_t[f], limit[f], mu_max[f],
+                x_c[f], mu_c[f], coef[f], base[f], b, deadline)
+            burned[f] = iterations[f] >= burn_in
+    x_new, mu_new, q_new, used, hit = draw(streams, x, mu, q_t, limit, mu_max, x_c, mu_c, coef, base, b,
+                                           max_iter, deadline, scale if proposal == 'adaptive' else None)
+    # only a chain which finished its burn-in is memorized, a later call burns the others in again
+    for i in range(0, k):
+        if burned[i]:
+            users[i].sheet.memo['chain'] = (x_new[i], mu_new[i], q_new[i], scale[i],
+                                            limit[i], mu_max[i], base[i], proposal)
+        else:
+            users[i].sheet.memo.pop('chain', None)
+    for i in range(0, k):
+        stats = users[i].learn_stats
+        stats['calls'] += 1
+        stats['iterations'] += int(iterations[i] + used[i])
+        stats['accepted'] += int(accepted[i] + hit[i])
+        stats['exhausted'] += int(not hit[i])
+    return x_new, mu_new
+
+
+def acceptance_rate(user):  # share of the proposals accepted over all the learn() calls of the user
+    stats = user.learn_stats
+    return stats['accepted']/max(stats['iterations'], 1)
+
+
+# metropolis_hastings sampling algorithms
+def metropolis_hastings(user):
+    model = user.model
+    x, mu = metropolis_hastings_batch([user], model.learn_iter, model.learn_time, model.proposal)
+    return x[0], mu[0]
+
+
+def surface(user, limit, mu_max, base, size):
+    # propensity weighted by the proposal density on a size x size grid of cells over [0, limit] x [0, mu_max],
+    # the stationary distribution of the chain; it is memorized until sheet_up() appends a row
+    key = ('grid', size, limit, mu_max, base)
+    memo = user.sheet.memo
+    if memo.get('grid_key') != key:
+        x_c, mu_c, coef, decay, folded = sheet_terms(user.sheet)
+        xs = (np.arange(size)+0.5)*limit/size  # centres of the cells
+        mus = (np.arange(size)+0.5)*mu_max/size
+        q = evaluate(np.repeat(xs, size), np.tile(mus, size), x_c, mu_c, coef, np.asarray(base))
+        p = np.maximum(q, 0)*np.outer(np.exp(-0.5*xs**2), np.exp(-0.5*mus**2)).ravel()
+        memo['grid_key'] = key
+        memo['grid'] = np.cumsum(p)
+    return memo['grid']
+
+
+# inverse-CDF sampling on a grid, a drop-in alternative to metropolis_hastings_batch
+def grid_sample(users, size=grid_size):
+    k = len(users)
+    x_new = np.zeros(k)
+    mu_new = np.zeros(k)
+    for i in range(0, k):
+        user = users[i]
+        limit = float(user.limit)
+        mu_max = float(mu_limit(user))
+        x_c, mu_c, coef, decay, folded = sheet_terms(user.sheet)
+        cdf = surface(user, limit, mu_max, user.p_ini*decay + folded, size)
+        total = cdf[-1]
+        stream = user.stream
+        user.learn_stats['calls'] += 1
+        if not total > 0:  # no cell is worth anything, fall back to the proposal
+            x_new[i] = stream.truncnorm(0, limit)
+            mu_new[i] = stream.truncnorm(0, mu_max)
+            continue
+        cell = min(int(np.searchsorted(cdf, stream.random()*total, side='right')), size*size-1)
+        x_new[i] = (cell // size + stream.random())*limit/size
+        mu_new[i] = (cell % size + stream.random())*mu_max/size
+    return x_new, mu_new
+
+
+class Chain:
+    # a user as the samplers see it, rebuilt from plain data in a worker process of the learning pool
+
+    def __init__(self, sheet, x, limit, market_role, mu, p_ini, seed):
+        self.sheet = sheet
+        self.x = x
+        self.limit = limit
+        self.market_role = market_role
+        self.mu = mu
+        self.p_ini = p_ini
+        self.stream = Stream(seed)
+        self.learn_stats = {'calls': 0, 'iterations': 0, 'accepted': 0, 'exhausted': 0}
+
+
+def learn_job(job):
+    # sample a group of users in a worker process, returns the (x, mu) drawn, the counters and the memos
+    # of their sheets
+    rows, mode, settings = job
+    users = [Chain(*row) for row in rows]
+    if mode == 'grid':
+        x, mu = grid_sample(users, *settings)
+    else:
+        x, mu = metropolis_hastings_batch(users, *settings)
+    return x, mu, [user.learn_stats for user in users], [user.sheet.memo for user in users]
+
+
+def learn_pool(users, model):
+    # learn_sample on the process pool of the model: the users are split in one group per worker, every one
+    # with a seed drawn from its own stream, so the draws don't depend on the number of workers or the groups;
+    # results are merged back in the order of users
+    if model.learn_mode == 'grid':
+        settings = (model.grid_size,)
+    else:
+        settings = (model.learn_iter, model.learn_time, model.proposal)
+    rows = [(user.sheet, float(user.x), float(user.limit), int(user.market_role), float(user.mu), float(user.p_ini),
+             user.stream.child()) for user in users]
+    group = max(1, -(-len(rows) // model.learn_workers))  # ceil(len(rows) / learn_workers)
+    jobs = [(rows[g:g+group], model.learn_mode, settings) for g in range(0, len(rows), group)]
+    x = np.zeros(len(users))
+    mu = np.zeros(len(users))
+    g = 0
+    for x_g, mu_g, stats, memos in model.pool.map(learn_job, jobs):
+        x[g:g+len(stats)] = x_g
+        mu[g:g+len(stats)] = mu_g
+        for user, counts, memo in zip(users[g:g+len(stats)], stats, memos):
+            user.sheet.memo = memo
+            for name, value in counts.items():
+                user.learn_stats[name] += value
+        g += len(stats)
+    return x, mu
+
+
+# draw new strategies (x, mu) for users with the learning mode of the model
+def learn_sample(users, model):
+    if model.pool is not None:
+        return learn_pool(users, model)
+    if model.learn_mode == 'grid':
+        return grid_sample(users, model.grid_size)
+    return metropolis_hastings_batch(users, model.learn_iter, model.learn_time, model.proposal)
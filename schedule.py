@@ -1,31 +1,110 @@
+import heapq
 import numpy as np
-from mesa.time import SimultaneousActivation
+from sampler import learn_sample
+from WaterUser import (role_choose_all, label_choose_all, bid_all, propensity_initialization_all,
+                       benefit_all, learn_price_all, learn_by_random_all)
 
 
-class MarketActivation(SimultaneousActivation):
+class MarketActivation:
+    # scheduler of the water market: a step runs the phases of the agents (balance, role, bids, propensity
+    # initialization, label) on the arrays of model.state for all the dirty agents at once, only the users over
+    # their limit are balanced one by one in the 'random' balance mode
+    # agents are kept in a list indexed by unique_id
 
     def __init__(self, model):
-        super().__init__(model)
+        self.model = model
+        self.agents = []
+        self.steps = 0
+        self.time = 0
+
+    @property
+    def agents_keys(self):
+        return range(len(self.agents))
+
+    def add(self, agent):
+        self.agents.append(agent)
+
+    def step(self):
+        # step the agents whose x, permit, mu, flows or trades changed since their last step,
+        # the others would recompute the same role, bids and label, so only their time advances
+        self.update()
+        self.model.state.time += 1
+        self.steps += 1
+        self.time += 1
+
+    def refresh(self, ids):
+        # step the dirty agents among ids
+        ids = np.unique(np.asarray(ids, dtype=int))
+        ids = ids[self.model.state.dirty[ids]]
+        self.update(ids)
+        self.model.state.time[ids] += 1
+
+    def traded(self, buyer, seller):  # the agents who traded have changed, step them
+        ids = np.concatenate((buyer, seller))
+        self.model.state.dirty[ids] = True
+        self.refresh(ids)
+
+    def update(self, ids=None):
+        # the phases of a step for the dirty agents among ids (all the dirty agents by default)
+        state = self.model.state
+        self.balance(ids)
+        if ids is None:
+            ids = np.flatnonzero(state.dirty)
+        role_choose_all(state, ids)
+        bid_all(state, ids)
+        propensity_initialization_all(state, ids[state.time[ids] == 0])
+        label_choose_all(state, ids)
+        state.dirty[ids] = False
+        state.dirty[ids[state.x[ids] > state.limit[ids]]] = True  # their inflow was cut after their balance
+
+    def balance(self, ids=None):
+        # balance the users among ids (all the dirty agents by default) which are over their limit
+        # with the 'projection' balance of the model, all the users over their limit are projected at once,
+        # level by level downstream (see Basin.balance)
+        # otherwise they are balanced one by one in ascending order of unique_id, and a sweep over all the agents
+        # also balances the users downstream that it pushes over their limit before reaching them
+        state = self.model.state
+        if self.model.balance_mode == 'projection':
+            self.model.basin.balance(state.x)
+            return
+        if ids is None:
+            ids = np.flatnonzero(state.dirty)
+            downstream = True
+        else:
+            downstream = False
+        pending = list(np.unique(np.asarray(ids, dtype=int)))  # sorted, so already a heap
+        last = -1
+        while pending:
+            i = heapq.heappop(pending)
+            if i <= last or state.x[i] <= state.limit[i]:
+                continue
+            last = i
+            self.agents[i].balance()
+            if downstream:
+                for j in self.model.basin.out_link(i):
+                    if j > i and state.x[j] > state.limit[j]:
+                        heapq.heappush(pending, j)
 
     def agent_count(self):
         self.num = len(self.agents)
 
-    def benefit(self, p_matrix, a_matrix):
-        for i in range(0, self.num):
-            self.agents[i].benefit_table(p_matrix[i], a_matrix[i])
-
-    def learn_d(self, p_matrix):
-        price_sum = np.sum(p_matrix)
-        non_zero = np.nonzero(p_matrix)[0].shape[0]  # get the total number of non-zeros
-
-        if non_zero != 0:
-            price_avg = price_sum / non_zero
-            for i in range(0, self.num):
-                z = np.array(p_matrix[i])
-                if np.sum(z) > 0:
-                    self.agents[i].learn()  # learn the outflow, water use and outflow to maximize the benefit
-                else:
-                    self.agents[i].learn_price(price_avg)  # only learn the price
+    def benefit(self, ledger):
+        # the benefits of all the agents in one pass, the agents whose trades met their demand record them
+        for i in benefit_all(self.model.state, self.model.basin, ledger):
+            self.agents[i].sheet_up()
+
+    def learn_d(self, ledger):
+        price_avg = ledger.price_mean()  # average price of the transactions
+
+        if price_avg is not None:
+            price_sum = ledger.price_sum()
+            learn_price_all(self.model.state, np.nonzero(price_sum <= 0)[0], price_avg)  # only learn the price
+            ids = np.nonzero(price_sum > 0)[0]
+            learners = [self.agents[i] for i in ids]
+            # learn the outflow, water use and outflow to maximize the benefit, all chains sampled in one batch
+            x, mu = learn_sample(learners, self.model)
+            for k in range(0, len(learners)):
+                learners[k].x, learners[k].mu = x[k], mu[k]
+            self.balance(ids)
         else:  # No transaction occurs in the market
-            for i in range(0, self.num):
-                self.agents[i].learn_by_random()
+            learn_by_random_all(self.agents)
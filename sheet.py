@@ -0,0 +1,121 @@
+import numpy as np
+
+
+phi = 0.1  # regency ratio
+pi = np.pi  # 3.1415926
+tolerance = 1e-8  # recency weight below which a row of the sheet is folded
+
+
+def window(tol):
+    # number of the newest rows whose recency weight (1-phi)**age is at least tol, None keeps them all
+    if not tol:
+        return None
+    return int(np.floor(np.log(tol)/np.log(1-phi))) + 1
+
+
+class Sheet:
+    # record of [x, mu, benefit] for every successful transaction, kept in a preallocated array
+    # which is compacted or doubled when it is full
+    # rows whose recency weight falls below tol are dropped and folded into a carried-forward term,
+    # so the cost of the propensity and the memory stay bounded; tol = 0 keeps the whole history
+
+    def __init__(self, row, tol=tolerance, capacity=64):
+        self.keep = window(tol)
+        self.rows = np.zeros((capacity, 3))
+        self.coef = np.zeros(capacity)  # relative change of the benefit of every row, divided by 2*pi
+        self.weights = (1-phi)**np.arange(capacity)  # (1-phi)**k, the recency weight of a row k appends old
+        self.start = 0  # position of the oldest kept row in self.rows
+        self.size = 0  # number of kept rows
+        self.count = 0  # number of rows appended so far
+        self.decay = 1.0  # (1-phi)**(count-1), the weight left to the initial propensity
+        self.folded = 0.0  # carried-forward contribution of the dropped rows
+        self.terms_cache = None
+        self.memo = {}  # work on the propensity surface of the sheet, kept until the next row is appended
+        self.append(row)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return self.rows[self.start:self.start+self.size][i]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.rows[self.start:self.start+self.size], dtype=dtype)
+
+    def resize(self):
+        capacity = self.rows.shape[0]
+        if self.size >= capacity // 2:
+            capacity = 2*capacity
+        rows = np.zeros((capacity, 3))
+        coef = np.zeros(capacity)
+        rows[:self.size] = self.rows[self.start:self.start+self.size]
+        coef[:self.size] = self.coef[self.start:self.start+self.size]
+        self.rows = rows
+        self.coef = coef
+        if self.weights.shape[0] != capacity:
+            self.weights = (1-phi)**np.arange(capacity)
+        self.start = 0
+
+    def append(self, row):
+        if self.start+self.size == self.rows.shape[0]:
+            self.resize()
+        end = self.start+self.size
+        self.rows[end] = row
+        if self.count > 0:
+            prev = self.rows[end-1][2]
+            self.coef[end] = (self.rows[end][2]-prev)/abs(prev)*1/(2*pi)
+            self.decay = self.decay*(1-phi)
+            self.folded = self.folded*(1-phi)
+        self.size += 1
+        self.count += 1
+        if self.keep is not None and self.size > self.keep:
+            # the oldest row no longer matters, fold it at the peak of its contribution
+            self.folded += self.coef[self.start]*self.weights[self.size-1]
+            self.start += 1
+            self.size -= 1
+        self.terms_cache = None
+        self.memo = {}
+
+    def terms(self):
+        # centres, scales and weighted coefficients of the kept contributions of the sheet,
+        # and the constant part, so that propensity = ini*decay + folded + sum(coef*gauss(x, mu))
+        if self.terms_cache is None:
+            s = self.start
+            e = self.start+self.size
+            if self.count == self.size:
+                s += 1  # the first row only serves as the reference of the second
+            rows = self.rows[s:e]
+            coef = self.coef[s:e]*self.weights[e-s-1::-1] if e > s else np.zeros(0)
+            self.terms_cache = (rows[:, 0], rows[:, 1], coef, self.decay, self.folded)
+        return self.terms_cache
+
+
+def sheet_terms(sheet):
+    if not isinstance(sheet, Sheet):  # a plain record of (x, mu, benefit)
+        rows = np.asarray(sheet, dtype=float).reshape(-1, 3)
+        sheet = Sheet(rows[0], tol=0, capacity=max(rows.shape[0], 1))
+        for row in rows[1:]:
+            sheet.append(row)
+    return sheet.terms()
+
+
+def evaluate(x, mu, x_c, mu_c, coef, base):
+    # score candidates against whole sheets in one pass
+    # x, mu: (..., b) candidates; x_c, mu_c, coef: (..., m) sheet terms; base: (...,) constant part
+    scale = x_c[..., None, :]
+    g = np.exp(-0.5*((x[..., None]-scale)/scale)**2-0.5*((mu[..., None]-mu_c[..., None, :])/scale)**2)
+    return base[..., None] + np.einsum('...bm,...m->...b', g, coef)
+
+
+def propensity(x, mu, sheet, ini):   # the sheet is a record of (x, mu, benefit)
+    # x and mu can be scalars or arrays of candidates, which are scored in one vectorized pass
+    x_c, mu_c, coef, decay, folded = sheet_terms(sheet)
+    x = np.asarray(x, dtype=float)
+    mu = np.asarray(mu, dtype=float)
+    shape = np.broadcast(x, mu).shape
+    x = np.broadcast_to(x, shape).reshape(-1)
+    mu = np.broadcast_to(mu, shape).reshape(-1)
+    q = evaluate(x, mu, x_c, mu_c, coef, np.asarray(ini*decay+folded, dtype=float))
+    if shape == ():
+        return q[0]
+    return q.reshape(shape)
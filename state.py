@@ -0,0 +1,122 @@
+import numpy as np
+
+
+# market roles and labels are stored as small-integer codes
+SIDER = 0
+BUYER = 1
+SELLER = 2
+ROLES = ('sider', 'buyer', 'seller')
+NORMAL = 0
+OVER = 1  # there are some water permits which can't be used
+LABELS = ('normal', 'over')
+
+
+class Column:
+    # an attribute of a WaterUser kept in the column of the same name of model.state,
+    # so a WaterUser is a view on row unique_id of the state
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, user, owner=None):
+        if user is None:
+            return self
+        return getattr(user.model.state, self.name)[user.unique_id]
+
+    def __set__(self, user, value):
+        getattr(user.model.state, self.name)[user.unique_id] = value
+
+
+class TrackedColumn(Column):
+    # an input of the derived state of a WaterUser (role, bids and label), every write marks the user dirty
+
+    def __set__(self, user, value):
+        state = user.model.state
+        getattr(state, self.name)[user.unique_id] = value
+        state.dirty[user.unique_id] = True
+
+
+class CodeColumn(Column):
+    # a coded column (market_role or label), written through the state to keep its counts and index sets
+
+    def __set__(self, user, value):
+        user.model.state.recode(self.name, user.unique_id, value)
+
+
+class IndexSet:
+    # set of user ids with O(1) insertion, removal, length and access by position
+
+    def __init__(self, n, members=()):
+        self.members = np.zeros(n, dtype=int)
+        self.pos = np.full(n, -1)  # position of every user in members, -1 if absent
+        self.size = 0
+        for i in members:
+            self.add(i)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, k):
+        return self.members[:self.size][k]
+
+    def __contains__(self, i):
+        return self.pos[i] >= 0
+
+    def add(self, i):
+        if self.pos[i] < 0:
+            self.members[self.size] = i
+            self.pos[i] = self.size
+            self.size += 1
+
+    def remove(self, i):
+        k = self.pos[i]
+        if k >= 0:
+            last = self.members[self.size-1]
+            self.members[k] = last
+            self.pos[last] = k
+            self.pos[i] = -1
+            self.size -= 1
+
+    def array(self):  # the members in ascending order of unique_id
+        return np.sort(self.members[:self.size])
+
+
+class AgentState:
+    # the state of all the users in contiguous NumPy columns indexed by unique_id, owned by the model
+    # market_role and label hold codes and are written through recode(), which keeps the number of users
+    # and the index set of every code up to date
+    # dirty marks the users whose x, permit, mu, flows or trades changed since they last stepped
+    floats = ('x', 'permit', 'limit', 'mu', 'bid_price', 'bid_amount', 'reservation_price', 'benefit',
+              'u_a', 'u_b', 'u_c', 'store', 'precipitation', 'res', 'beta', 'p_ini')
+    codes = {'market_role': ROLES, 'label': LABELS}
+
+    def __init__(self, n):
+        self.n = n
+        for name in self.floats:
+            setattr(self, name, np.zeros(n))
+        self.time = np.zeros(n, dtype=int)
+        self.dirty = np.ones(n, dtype=bool)
+        self.count = {}
+        self.index = {}
+        for name, values in self.codes.items():
+            setattr(self, name, np.zeros(n, dtype=np.int8))  # every user starts with code 0
+            self.count[name] = np.zeros(len(values), dtype=int)
+            self.count[name][0] = n
+            self.index[name] = [IndexSet(n, range(n) if c == 0 else ()) for c in range(len(values))]
+
+    def recode(self, name, ids, codes):
+        # set the codes of column name for the users ids, only the users whose code changes cost anything
+        column = getattr(self, name)
+        ids, codes = np.broadcast_arrays(np.asarray(ids, dtype=int).reshape(-1), np.asarray(codes).reshape(-1))
+        old = column[ids]
+        changed = np.nonzero(old != codes)[0]
+        if changed.shape[0] == 0:
+            return
+        count = self.count[name]
+        count -= np.bincount(old[changed], minlength=count.shape[0])
+        count += np.bincount(codes[changed], minlength=count.shape[0])
+        index = self.index[name]
+        for k in changed:
+            index[old[k]].remove(ids[k])
+            index[codes[k]].add(ids[k])
+        column[ids[changed]] = codes[changed]
@@ -0,0 +1,57 @@
+import numpy as np
+from scipy.special import ndtr, ndtri
+
+
+buffer_size = 4096  # uniforms drawn at a time for scalar draws
+
+
+def spawn(seed, n):
+    # independent seeds for n streams, derived from one seed of the model
+    return np.random.SeedSequence(seed).spawn(n)
+
+
+class Stream:
+    # a seeded random stream owned by a user (or by the market)
+    # scalar draws are served from a buffer of uniforms which is refilled in bulk,
+    # draws with a size go to the generator directly
+
+    def __init__(self, seed=None, size=buffer_size):
+        self.generator = np.random.default_rng(seed)
+        self.size = size
+        self.buffer = np.zeros(0)
+        self.pos = 0
+
+    def random(self, size=None):  # uniform draws in [0, 1)
+        if size is not None:
+            return self.generator.random(size)
+        if self.pos == self.buffer.shape[0]:
+            self.buffer = self.generator.random(self.size)
+            self.pos = 0
+        u = self.buffer[self.pos]
+        self.pos += 1
+        return u
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return low + (high-low)*self.random(size)
+
+    def integers(self, low, high=None, size=None):  # integers in [low, high), or in [0, low) if high is None
+        if high is None:
+            low, high = 0, low
+        k = np.floor(low + (high-low)*self.random(size))
+        if size is None:
+            return int(k)
+        return k.astype(int)
+
+    def normal(self, size=None):  # standard normal draws
+        if size is not None:
+            return self.generator.standard_normal(size)
+        return ndtri(self.random())
+
+    def child(self):  # a seed for a stream derived from this one, e.g. for a job run in another process
+        return int(self.generator.integers(2**63))
+
+    def truncnorm(self, a, b, size=None):
+        # standard normal truncated to [a, b], drawn by the inverse of its CDF
+        # (the same distribution as scipy.stats.truncnorm.rvs(a, b))
+        lo = ndtr(a)
+        return ndtri(lo + (ndtr(b)-lo)*self.random(size))